@@ -0,0 +1,294 @@
+"""
+Benchmarks for csv2cmdb, run against the local mock server in mock_freshservice.py.
+A freshlogin.py must be importable, but no request leaves localhost. The mock shares the
+benchmark's process, so absolute request rates are a lower bound; compare runs against each other.
+
+    python benchmark.py pagination --items 3000 --latency 0.05 --workers 8
+    python benchmark.py streaming --items 100000
+    python benchmark.py payloads --items 50000
+    python benchmark.py ingest --sizes 1000 10000 100000 --workers 16
+    python benchmark.py imports --max-ms 150
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import subprocess
+import argparse
+import tempfile
+import tracemalloc
+from contextlib import redirect_stdout
+import pandas as pd
+import csv2cmdb as c
+import metrics
+from mock_freshservice import MockFreshservice, make_items
+
+
+def timed(func, *args, **kwargs):
+    """Returns (seconds, result) for a single call of func."""
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def traced(func, *args, **kwargs):
+    """Returns (seconds, peak traced MiB, result) for a single call of func."""
+    tracemalloc.start()
+    try:
+        seconds, result = timed(func, *args, **kwargs)
+        peak = tracemalloc.get_traced_memory()[1] / 2 ** 20
+    finally:
+        tracemalloc.stop()
+    return seconds, peak, result
+
+
+def bench_pagination(args):
+    """Compare serial and windowed-parallel fetching of every /cmdb/items.json page"""
+    with MockFreshservice(make_items(args.items), latency=args.latency) as mock:
+        c.configure_client(base_url=mock.url, pool_maxsize=max(args.workers, 10))
+        # pages go through send(), so lift the client-side limiter to measure pagination itself
+        c.configure_rate_limit(10 ** 9)
+        serial, pages = timed(lambda: list(c._iter_pages(c._fetch_item_page)))
+        parallel, parallel_pages = timed(lambda: list(c._iter_pages(c._fetch_item_page, args.workers)))
+    assert parallel_pages == pages, "parallel pagination returned different pages"
+    print(f"{len(pages)} pages, {args.latency * 1000:.0f} ms latency")
+    print(f"serial:             {serial:8.3f} s")
+    print(f"parallel ({args.workers:>2} workers): {parallel:8.3f} s  ({serial / parallel:.1f}x)")
+
+
+def bench_streaming(args):
+    """Fetch every CI from the mock server three ways: growing a DataFrame page by page as the
+    original get_assets() did, with get_assets(), and streaming records with iter_assets()"""
+    with MockFreshservice(make_items(args.items)) as mock:
+        c.configure_client(base_url=mock.url, pool_maxsize=max(args.workers, 10))
+        c.configure_rate_limit(10 ** 9)
+        # build the mock's listing before anything is traced
+        c._fetch_item_page(1)
+
+        def per_page_concat():
+            # what DataFrame.append did: copy the whole accumulated table for every page
+            table = pd.DataFrame()
+            for page in c._iter_pages(c._fetch_item_page, args.workers):
+                table = pd.concat([table, pd.DataFrame(page)], ignore_index=True)
+            return table
+
+        def streamed():
+            return sum(1 for _ in c.iter_assets(args.workers))
+
+        old_time, old_peak, old_table = traced(per_page_concat)
+        new_time, new_peak, new_table = traced(c.get_assets, workers=args.workers)
+        stream_time, stream_peak, streamed_count = traced(streamed)
+    assert old_table.equals(new_table), "get_assets() differs from the concatenated table"
+    assert streamed_count == len(new_table), "iter_assets() yielded a different number of CIs"
+    print(f"{len(new_table)} CIs, {args.workers} workers")
+    print(f"per-page concat: {old_time:8.3f} s  peak {old_peak:8.1f} MiB")
+    print(f"get_assets():    {new_time:8.3f} s  peak {new_peak:8.1f} MiB")
+    print(f"iter_assets():   {stream_time:8.3f} s  peak {stream_peak:8.1f} MiB")
+
+
+def bench_payloads(args):
+    """Compare building a dict and calling json.dumps per CI with the templated PayloadBuilder"""
+    type_ids = list(c.ASSET_DICT.values())
+    changes = [c.Change("create", f"id-{number:08x}", None, f"CI {number}", type_ids[number % len(type_ids)],
+                        f"Synthetic item {number} with a longer description", {})
+               for number in range(args.items)]
+
+    def level_field_attributes(ci_type):
+        return {f'file_imported_from_{ci_type}': "elements.csv"}
+
+    def per_row_dumps():
+        return [json.dumps({'cmdb_config_item':
+                            {'name': change.name,
+                             'ci_type_id': change.ci_type_id,
+                             'description': change.description,
+                             'asset_tag': change.guid,
+                             'level_field_attributes': level_field_attributes(change.ci_type_id)}})
+                for change in changes]
+
+    def templated():
+        builder = c.PayloadBuilder(level_field_attributes)
+        return [builder.build(change) for change in changes]
+
+    old_time, old_payloads = timed(per_row_dumps)
+    new_time, new_payloads = timed(templated)
+    assert [json.loads(payload) for payload in old_payloads] == \
+        [json.loads(payload) for payload in new_payloads], "payloads differ"
+    backend = "orjson" if c.orjson is not None else "json"
+    print(f"{args.items} payloads")
+    print(f"dict + json.dumps:      {args.items / old_time:12,.0f} payloads/s")
+    print(f"PayloadBuilder ({backend}): {args.items / new_time:12,.0f} payloads/s")
+
+
+def write_archi_export(folder, elements, relations_per_element=1):
+    """Write a synthetic Archi CSV export (elements.csv and relations.csv) to folder.
+    Returns the two paths.
+    Parameters
+    ----------
+    folder: str
+        Directory the files are written to.
+    elements: int
+        Number of elements. Types cycle through the known element types.
+    relations_per_element: int, optional
+        Relations whose source is each element. Default is 1.
+    """
+    element_types = list(c.ASSET_DICT)
+    relation_types = list(c.RELA_DICT)
+    ids = [f"id-{number:032x}" for number in range(elements)]
+    element_table = pd.DataFrame({"ID": ids,
+                                  "Type": [element_types[number % len(element_types)]
+                                           for number in range(elements)],
+                                  "Name": [f"Element {number} (synthetic)" for number in range(elements)],
+                                  "Documentation": [f"Synthetic element {number}" for number in range(elements)],
+                                  "Specialization": ""})
+    rows = [(f"rel-{source:08x}-{step}", relation_types[(source + step) % len(relation_types)], "", "",
+             ids[source], ids[(source * 7 + step + 1) % elements], "")
+            for source in range(elements) for step in range(relations_per_element)]
+    relation_table = pd.DataFrame(rows, columns=["ID", "Type", "Name", "Documentation",
+                                                 "Source", "Target", "Specialization"])
+    relation_table = relation_table.drop_duplicates(subset=["Type", "Source", "Target"])
+    elements_path = os.path.join(folder, "elements.csv")
+    relations_path = os.path.join(folder, "relations.csv")
+    element_table.to_csv(elements_path, index=False)
+    relation_table.to_csv(relations_path, index=False)
+    return elements_path, relations_path
+
+
+def bench_ingest(args):
+    """Ingest, then permanently delete, synthetic Archi exports of each size through the mock
+    server, reporting throughput and request counts"""
+    ci_types = [{"ci_type": {"id": int(type_id), "name": name}} for name, type_id in c.ASSET_DICT.items()]
+    relationship_types = [{"id": int(type_id), "forward_relationship": name, "backward_relationship": name,
+                           "created_at": "2019-01-01T00:00:00-04:00"}
+                          for name, type_id in c.RELA_DICT.items()]
+    print(f"{'size':>8}{'phase':>9}{'seconds':>10}{'items/s':>10}{'requests':>10}{'429s':>6}")
+    for size in args.sizes:
+        with tempfile.TemporaryDirectory() as folder, \
+                MockFreshservice(latency=args.latency, rate_limit=args.rate_limit,
+                                 ci_types=ci_types, relationship_types=relationship_types) as mock:
+            elements, relations = write_archi_export(folder, size)
+            c.TYPE_MAP_CACHE = os.path.join(folder, "type_ids.json")
+            c.refresh_metadata()
+            c.configure_snapshot_cache(os.path.join(folder, "snapshots.sqlite"))
+            c.configure_client(base_url=mock.url, pool_maxsize=max(args.workers, 10))
+            c.configure_rate_limit(args.rate_limit or 10 ** 9)
+            c.WRITE_WORKERS = args.workers
+            metrics.get_metrics().reset()
+            output = io.StringIO()
+            with redirect_stdout(output):
+                ingest_time, _ = timed(lambda: (
+                    c.add_update_assets(elements, "csv", chunksize=args.chunksize),
+                    c.add_rela(relations, elements, "csv", os.path.join(folder, "rejected.csv"),
+                               chunksize=args.chunksize)))
+            ingest_requests = c.get_calls()
+            edges = sum(len(entries) for entries in mock.cmdb.relationships.values())
+            assert len(mock.cmdb.items) == size, f"ingest created {len(mock.cmdb.items)} of {size} CIs"
+            with redirect_stdout(output):
+                delete_time, _ = timed(c.mass_delete, elements, "csv", permanent=True,
+                                       log_file=os.path.join(folder, "deleted.json"))
+            assert not mock.cmdb.items and not mock.cmdb.trash, "delete left CIs behind"
+            print(f"{size:>8}{'ingest':>9}{ingest_time:>10.2f}{(size + edges) / ingest_time:>10,.0f}"
+                  f"{ingest_requests:>10}{mock.throttled:>6}")
+            print(f"{size:>8}{'delete':>9}{delete_time:>10.2f}{size / delete_time:>10,.0f}"
+                  f"{c.get_calls() - ingest_requests:>10}{mock.throttled:>6}")
+            if args.profile:
+                print(metrics.get_metrics().summary())
+
+
+# modules that must not be executed just by importing main.py or csv2cmdb
+HEAVY_MODULES = ["pandas.core", "numpy._core", "requests.sessions", "boxsdk"]
+
+
+def import_times(module):
+    """Returns {module: cumulative microseconds} from `python -X importtime -c "import module"`
+    run in a fresh interpreter, in the order the modules finished importing."""
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            cwd=os.path.dirname(os.path.abspath(__file__)),
+                            capture_output=True, text=True)
+    if result.returncode:
+        raise RuntimeError(f"import {module} failed:\n{result.stderr[-2000:]}")
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+def heavy_imports(times):
+    """Returns the HEAVY_MODULES (and their submodules) found in an import_times() result."""
+    return sorted({name for name in times for prefix in HEAVY_MODULES
+                   if name == prefix or name.startswith(prefix + ".")})
+
+
+def bench_imports(args):
+    """Measure the import time of main.py and csv2cmdb with python -X importtime and check that
+    the heavy dependencies are only loaded by the code paths that use them"""
+    failed = False
+    for module in args.modules:
+        runs = [import_times(module) for _ in range(args.repeat)]
+        best = min(run[module] for run in runs) / 1000
+        heavy = heavy_imports(runs[0])
+        print(f"import {module:<10} {best:8.1f} ms (best of {args.repeat})")
+        if heavy:
+            failed = True
+            print(f"  loads heavy modules at import time: {', '.join(heavy[:8])}")
+        if args.max_ms and best > args.max_ms:
+            failed = True
+            print(f"  slower than the {args.max_ms} ms budget")
+    start = time.perf_counter()
+    subprocess.run([sys.executable, "main.py", "--help"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                   capture_output=True, check=True)
+    print(f"main.py --help     {(time.perf_counter() - start) * 1000:8.1f} ms")
+    if failed:
+        exit(1)
+
+
+if __name__ == "__main__":
+
+    main_parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = main_parser.add_subparsers(title="benchmarks")
+
+    pagination_parser = subparsers.add_parser('pagination', description=bench_pagination.__doc__)
+    pagination_parser.add_argument("--items", type=int, default=3000)
+    pagination_parser.add_argument("--latency", type=float, default=0.05)
+    pagination_parser.add_argument("--workers", type=int, default=8)
+    pagination_parser.set_defaults(func=bench_pagination)
+
+    streaming_parser = subparsers.add_parser('streaming', description=bench_streaming.__doc__)
+    streaming_parser.add_argument("--items", type=int, default=100000)
+    streaming_parser.add_argument("--workers", type=int, default=4)
+    streaming_parser.set_defaults(func=bench_streaming)
+
+    payloads_parser = subparsers.add_parser('payloads', description=bench_payloads.__doc__)
+    payloads_parser.add_argument("--items", type=int, default=50000)
+    payloads_parser.set_defaults(func=bench_payloads)
+
+    ingest_parser = subparsers.add_parser('ingest', description=bench_ingest.__doc__)
+    ingest_parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000],
+                               help='numbers of elements to ingest, one run each')
+    ingest_parser.add_argument("--latency", type=float, default=0.0)
+    ingest_parser.add_argument("--rate-limit", type=int, default=None,
+                               help="mock server requests per minute; unlimited by default")
+    ingest_parser.add_argument("--workers", type=int, default=16)
+    ingest_parser.add_argument("--chunksize", type=int, default=None)
+    ingest_parser.add_argument("--profile", action="store_true",
+                               help='print the per-endpoint request metrics after each size')
+    ingest_parser.set_defaults(func=bench_ingest)
+
+    imports_parser = subparsers.add_parser('imports', description=bench_imports.__doc__)
+    imports_parser.add_argument("--modules", nargs="+", default=["main", "csv2cmdb"])
+    imports_parser.add_argument("--repeat", type=int, default=5)
+    imports_parser.add_argument("--max-ms", type=float, default=None,
+                                help='exit with status 1 if an import takes longer than this')
+    imports_parser.set_defaults(func=bench_imports)
+
+    args = main_parser.parse_args()
+    if not hasattr(args, "func"):
+        main_parser.print_help()
+        exit(1)
+    args.func(args)
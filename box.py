@@ -1,5 +1,52 @@
+import os
+import hashlib
+import threading
+import time
+from urllib.parse import urlparse
 from boxsdk import JWTAuth, Client # need pyjwt and cryptography
+from boxsdk.network.default_network import DefaultNetwork
+from boxsdk.session.session import AuthorizedSession
 import boxsdk as b
+import metrics
+
+# Box only accepts upload sessions for files of at least 20 MB
+CHUNKED_UPLOAD_THRESHOLD = 20000000
+
+_client = None
+_client_lock = threading.Lock()
+
+
+class MeteredNetwork(DefaultNetwork):
+    # records every Box request, token refreshes and retries included, in the shared metrics
+
+    def request(self, method, url, access_token, **kwargs):
+        path = urlparse(url).path
+        start = time.perf_counter()
+        try:
+            response = super().request(method, url, access_token, **kwargs)
+        except Exception:
+            metrics.record_call("box", method.upper(), path, time.perf_counter() - start,
+                                bytes_sent=metrics.body_size(kwargs.get('data')))
+            raise
+        # the response may be a streamed download, so its size is taken from the headers
+        metrics.record_call("box", method.upper(), path, time.perf_counter() - start,
+                            response.status_code, metrics.body_size(kwargs.get('data')),
+                            int(response.headers.get('Content-Length') or 0))
+        if response.status_code == 429 or response.status_code >= 500:
+            # the box session retries these
+            metrics.record_retry("box", method.upper(), path)
+        return response
+
+
+def get_client():
+    # authenticates once and reuses the client (and its token refreshes) for every upload
+    global _client
+    with _client_lock:
+        if _client is None:
+            network = MeteredNetwork()
+            auth = JWTAuth.from_settings_file('key.json', network_layer=network)
+            _client = Client(auth, session=AuthorizedSession(auth, network_layer=network))
+        return _client
 
 
 def box_upload_elements(file):
@@ -12,17 +59,42 @@ def box_upload_relations(file):
     box_uploader(88582357248, file)
 
 
+def file_sha1(file):
+    # Box reports the SHA-1 of every file, so this is what unchanged files are compared by
+    digest = hashlib.sha1()
+    with open(file, 'rb') as stream:
+        for block in iter(lambda: stream.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
 def box_uploader(folder_id, file):
     # this is the function that does the actual uploading
-    auth = JWTAuth.from_settings_file('key.json')
-    cli = Client(auth)
+    cli = get_client()
     f = cli.folder(folder_id=folder_id)
+    size = os.path.getsize(file)
     try:
-        uploaded_file = f.upload(file)
+        f.preflight_check(size, os.path.basename(file))
+        conflict = None
     except b.exception.BoxAPIException as ex:
+        if ex.status != 409:
+            raise
+        conflict = ex.context_info['conflicts']
+    if conflict is None:
+        if size >= CHUNKED_UPLOAD_THRESHOLD:
+            uploaded_file = f.get_chunked_uploader(file).start()
+        else:
+            uploaded_file = f.upload(file, preflight_check=False)
+    elif conflict.get('sha1') == file_sha1(file):
+        uploaded_file = cli.file(conflict['id'])
+        print(file + ' is unchanged, skipping the upload.')
+    else:
         # update the file instead
-        conflict = ex.context_info['conflicts']['id']
-        uploaded_file = cli.file(conflict).update_contents(file, etag=None, preflight_check=False)
+        existing = cli.file(conflict['id'])
+        if size >= CHUNKED_UPLOAD_THRESHOLD:
+            uploaded_file = existing.get_chunked_uploader(file).start()
+        else:
+            uploaded_file = existing.update_contents(file, etag=None, preflight_check=False)
         print('File already exists.')
     print(file + ' can be acessed with this link: ' + uploaded_file.get_shared_link(access='company'))
 
@@ -36,6 +108,4 @@ def share_folders(client):
 
 
 if __name__ == '__main__':
-    sdk = JWTAuth.from_settings_file('key.json')
-    client = Client(sdk)
-    share_folders(client)
\ No newline at end of file
+    share_folders(get_client())
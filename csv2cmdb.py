@@ -3,13 +3,46 @@ These functions read/write data generated from Archi into Freshservice's CMDB vi
 """
 
 import re
+import os
+import sys
 import json
-import difflib
+import hashlib
+import sqlite3
 import datetime as dt
-import requests
-import numpy
-import pandas as pd
+import time
+import threading
+import importlib.util
+from collections import namedtuple
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import freshlogin as fresh
+import metrics
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _lazy_import(name):
+    """Returns a module that is only executed when one of its attributes is first used, so
+    importing csv2cmdb (e.g. for main.py --help) does not pay for pandas, numpy and requests.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ImportError(f"No module named {name!r}", name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+requests = _lazy_import("requests")
+numpy = _lazy_import("numpy")
+pd = _lazy_import("pandas")
 
 
 ASSET_DICT = {"ApplicationComponent": "10001075119",
@@ -39,48 +72,591 @@ RELA_DICT = {'CompositionRelationship': '10000527161',
              'AssociationRelationship': '10000527165',
              'ServingRelationship': '10000527167'}
 
+PARENTHESES = re.compile(r'\([^)]*\)')
+
+
+def normalize_names(names):
+    """Returns canonical CI names for a Series of Archi names: parenthesised text removed and
+    surrounding whitespace stripped, in one vectorized pass.
+    """
+    return names.astype(str).str.replace(PARENTHESES, '', regex=True).str.strip()
+
+
+def normalize_upload(upload_data):
+    """Returns the canonical GUID, name, type and description columns of an upload frame, as
+    compared by plan_changes() and sent by apply_plan().
+    Parameters
+    ----------
+    upload_data: DataFrame
+        Rows with "Name", "Type" (ci_type_id), "GUID" and "Documentation" columns.
+    """
+    return pd.DataFrame({
+        "GUID": upload_data["GUID"].astype(str),
+        "new_name": normalize_names(upload_data["Name"]),
+        "new_type": upload_data["Type"].astype(str),
+        "new_description": upload_data["Documentation"].fillna("").astype(str),
+    })
+
+
+_TYPE_STOPWORDS = {"to", "with", "of", "by", "is", "the", "a", "relationship"}
+
+
+def _type_tokens(name):
+    """Split a type name into lowercase words, breaking CamelCase and dropping filler words."""
+    words = re.findall(r"[A-Z]?[a-z]+|[A-Z]+(?![a-z])|\d+", str(name))
+    return [word.lower() for word in words if word.lower() not in _TYPE_STOPWORDS]
+
+
+def _trigrams(text):
+    padded = f"  {text} "
+    return {padded[start:start + 3] for start in range(len(padded) - 2)}
+
+
+class TypeMatcher:
+    """Fuzzy matcher from free-form type names onto a fixed vocabulary (e.g. Archi element or
+    relationship types). Names are normalised and indexed by character trigrams once, so each
+    lookup only scores the vocabulary entries sharing a trigram with the query.
+    Parameters
+    ----------
+    vocabulary: iterable of str
+        Names that lookups resolve to.
+    """
+
+    def __init__(self, vocabulary):
+        self.vocabulary = list(dict.fromkeys(vocabulary))
+        self.exact = {}
+        self.grams = []
+        self.index = {}
+        for position, name in enumerate(self.vocabulary):
+            normalized = "".join(_type_tokens(name))
+            self.exact.setdefault(normalized, name)
+            grams = _trigrams(normalized)
+            self.grams.append(grams)
+            for gram in grams:
+                self.index.setdefault(gram, []).append(position)
+
+    def match(self, name, cutoff=0.5):
+        """Returns the vocabulary entry closest to name, or None if none scores above cutoff.
+        Scores are Dice coefficients over character trigrams of the normalised names.
+        """
+        normalized = "".join(_type_tokens(name))
+        if normalized in self.exact:
+            return self.exact[normalized]
+        grams = _trigrams(normalized)
+        shared = {}
+        for gram in grams:
+            for position in self.index.get(gram, ()):
+                shared[position] = shared.get(position, 0) + 1
+        best, best_score = None, cutoff
+        for position, count in shared.items():
+            score = 2 * count / (len(grams) + len(self.grams[position]))
+            if score > best_score:
+                best, best_score = self.vocabulary[position], score
+        return best
+
+
+def _match_types(named_ids, defaults, kind, keep_unmatched=False):
+    """Map (Freshservice name, ID) pairs onto the Archi types in defaults. An exact match of the
+    normalised names always wins; a fuzzy match is used for an Archi type without an exact
+    match, and the caller's defaults fill in the rest. Collisions are reported, not
+    overwritten: the first candidate is kept.
+    Parameters
+    ----------
+    named_ids: iterable of (str, str)
+        Freshservice type names and IDs, in the order the API lists them.
+    defaults: dict
+        Built-in Archi type -> ID mapping; its keys are the vocabulary matched against.
+    kind: str
+        Type kind used in messages, e.g. "CI".
+    keep_unmatched: bool, optional
+        If True, names that are not used for an Archi type are returned keyed by the name
+        without spaces. Default is False.
+    """
+    matcher = TypeMatcher(defaults)
+    exact, fuzzy, unmatched = {}, {}, {}
+    for name, type_id in named_ids:
+        entry = matcher.exact.get("".join(_type_tokens(name)))
+        if entry is None:
+            fuzzy_entry = matcher.match(name)
+            if fuzzy_entry is not None:
+                fuzzy.setdefault(fuzzy_entry, []).append((name, type_id))
+            else:
+                unmatched[str(name).replace(" ", "")] = type_id
+        elif entry in exact:
+            print(f"{kind} types {exact[entry][0]!r} and {name!r} both match {entry}; "
+                  f"keeping {exact[entry][1]}")
+        else:
+            exact[entry] = (name, type_id)
+    resolved = {}
+    for entry, candidates in fuzzy.items():
+        names = ", ".join(repr(name) for name, _ in candidates)
+        if entry in exact:
+            print(f"Not using {kind} type {names} for {entry}: its exact match takes precedence")
+        else:
+            if len(candidates) > 1:
+                print(f"{kind} types {names} all resemble {entry}; keeping {candidates[0][1]}")
+            resolved[entry] = candidates[0][1]
+            candidates = candidates[1:]
+        for name, type_id in candidates:
+            unmatched.setdefault(str(name).replace(" ", ""), type_id)
+    if keep_unmatched:
+        resolved = {**unmatched, **resolved}
+    resolved.update({entry: type_id for entry, (_, type_id) in exact.items()})
+    return resolved
+
 
 def get_rela_ids():
     """Return a dictionary consisting of Archi relationship types paired with their
-    Freshservice relationship IDs.
-    """
-    match_dict = ['CompositionRelationship',
-                  'RealizationRelationship',
-                  'AccessRelationship',
-                  'AssignmentRelationship',
-                  'FlowRelationship',
-                  'TriggeringRelationship',
-                  'AssociationRelationship',
-                  'ServingRelationship']
-    rela_dict = {}
-    for item in get_rela_types():
-        early_creation = dt.datetime(2018, 8, 2, 0, 0, 0)
-        if dt.datetime.strptime(item["created_at"], "%Y-%m-%dT%H:%M:%S-04:00") > early_creation:
-            rela = difflib.get_close_matches(item["forward_relationship"].replace(" ", "")
-                                             .replace("to", "")
-                                             .replace("with", "")+"Relationship", match_dict)[0]
-            rela_dict[rela] = str(item["id"])
-        else:
-            pass
-    return rela_dict
+    Freshservice relationship IDs. Only relationship types created after 2018-08-02 (the
+    Archi import) are considered; see _match_types() for how names are matched.
+    """
+    early_creation = _utc_timestamp("2018-08-02T00:00:00+00:00")
+    return _match_types([(item["forward_relationship"], str(item["id"])) for item in get_rela_types()
+                         if _utc_timestamp(item["created_at"]) > early_creation],
+                        RELA_DICT, "Relationship")
+
+
+# (connect, read) seconds
+REQUEST_TIMEOUT = (10, 120)
+
+
+class FreshClient:
+    """Pooled HTTP session that every Freshservice API call is routed through, so
+    connections are kept alive and reused instead of re-negotiated per request.
+    Parameters
+    ----------
+    domain: str, optional
+        Freshservice domain. Default is freshlogin.domain.
+    user, password, api_key: str, optional
+        Credentials. Defaults are taken from freshlogin.
+    pool_connections: int, optional
+        Number of per-host connection pools to keep. Default is 10.
+    pool_maxsize: int, optional
+        Maximum number of kept-alive connections per host. Default is 20.
+    base_url: str, optional
+        Overrides "https://{domain}", e.g. to point at a local test server.
+    timeout: float or tuple, optional
+        Default requests timeout, as seconds or (connect, read) seconds, so a stalled
+        connection cannot hold a worker forever. Default is REQUEST_TIMEOUT.
+    """
+
+    def __init__(self, domain=None, user=None, password=None, api_key=None,
+                 pool_connections=10, pool_maxsize=20, base_url=None, timeout=None):
+        self.domain = domain or fresh.domain
+        self.timeout = timeout or REQUEST_TIMEOUT
+        self.base_url = (base_url or f"https://{self.domain}").rstrip("/")
+        password = password or fresh.password
+        self.auth = (user or fresh.user, password)
+        self.key_auth = (api_key or fresh.api_key, password)
+        self.pool_maxsize = pool_maxsize
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_connections,
+                                                pool_maxsize=pool_maxsize)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({'Content-Type': 'application/json',
+                                     'Connection': 'keep-alive'})
+        self.session.auth = self.auth
+
+    def request(self, method, path, **kwargs):
+        """Send a request for a path relative to the Freshservice domain, recording it in the
+        shared metrics registry. A str body is sent as UTF-8, whichever JSON encoder made it;
+        http.client would otherwise encode it as Latin-1 under urllib3 1.x."""
+        kwargs.setdefault("timeout", self.timeout)
+        if isinstance(kwargs.get("data"), str):
+            kwargs["data"] = kwargs["data"].encode("utf-8")
+        start = time.perf_counter()
+        try:
+            response = self.session.request(method, self.base_url + path, **kwargs)
+        except requests.RequestException:
+            metrics.record_call("freshservice", method, path, time.perf_counter() - start,
+                                bytes_sent=metrics.body_size(kwargs.get("data")))
+            raise
+        metrics.record_call("freshservice", method, path, time.perf_counter() - start,
+                            response.status_code, metrics.body_size(kwargs.get("data")),
+                            len(response.content))
+        return response
+
+    def get(self, path, **kwargs):
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request("POST", path, **kwargs)
+
+    def put(self, path, **kwargs):
+        return self.request("PUT", path, **kwargs)
+
+    def delete(self, path, **kwargs):
+        return self.request("DELETE", path, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+
+_client = None
+_client_lock = threading.Lock()
+_metadata = {}
+_metadata_lock = threading.RLock()
+
+
+def get_client():
+    """Returns the shared FreshClient, creating it from freshlogin on first use.
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = FreshClient()
+        return _client
+
+
+def configure_client(**kwargs):
+    """Replace the shared FreshClient, e.g. to change pool sizes or the base URL.
+    Accepts the same keyword arguments as FreshClient.
+    """
+    global _client
+    with _client_lock:
+        if _client is not None:
+            _client.close()
+        _client = FreshClient(**kwargs)
+        return _client
 
 
 def get_calls():
     """Returns number of API calls made in Python session
     """
-    get_calls.counter += 1
+    return metrics.get_metrics().total_calls("freshservice")
+
+
+RATE_LIMIT_PER_MINUTE = 100
+WRITE_WORKERS = 4
+READ_WORKERS = 1
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+RELATIONSHIP_CHECKPOINT = "freshservice_relationships.partial.jsonl"
+CHECKPOINT_MAX_AGE = 6 * 60 * 60
+METADATA_TTL = 60 * 60
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "csv2cmdb")
+SNAPSHOT_TTL = 60 * 60
+TYPE_MAP_CACHE = os.path.join(CACHE_DIR, "type_ids.json")
+TYPE_MAP_TTL = 24 * 60 * 60
+# bumped when the matching rules change, so mappings cached by older rules are rediscovered
+TYPE_MAP_VERSION = 3
+
+Operation = namedtuple("Operation", ["method", "path", "data", "auth", "label"],
+                       defaults=(None, None, ""))
+Operation.__doc__ = """One API request queued for execute(). auth defaults to the client's
+user/password; label is used in reports."""
+
+
+class RateLimiter:
+    """Thread-safe token bucket that spaces requests to stay under a per-minute quota.
+    Parameters
+    ----------
+    per_minute: int
+        Requests allowed per minute for the Freshservice account.
+    burst: int, optional
+        Requests that may be sent back to back after an idle period. Default is per_minute/10.
+    """
 
-get_calls.counter = 0
+    def __init__(self, per_minute, burst=None):
+        self.rate = per_minute / 60.0
+        self.capacity = max(1, burst or per_minute // 10)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a request may be sent."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if now >= self.paused_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = max(self.paused_until - now, (1 - self.tokens) / self.rate)
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """Hold every worker for the given number of seconds, e.g. after a 429."""
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self.tokens = 0.0
+
+
+_limiter = RateLimiter(RATE_LIMIT_PER_MINUTE)
+
+
+def configure_rate_limit(per_minute, burst=None):
+    """Replace the account-wide RateLimiter shared by every execute() call.
+    """
+    global _limiter
+    _limiter = RateLimiter(per_minute, burst)
+    return _limiter
+
+
+def _retry_delay(response, attempt, backoff):
+    """Seconds to wait before retrying: Retry-After if the server sent one, else exponential."""
+    if response is not None:
+        try:
+            return float(response.headers["Retry-After"])
+        except (KeyError, ValueError):
+            pass
+    return backoff * 2 ** attempt
+
+
+def _not_sent(error):
+    """True if a connection error happened before the request reached the server."""
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], "reason", None) if error.args else None
+    return isinstance(reason, requests.adapters.NewConnectionError)
+
+
+def send(operation, max_retries=5, backoff=1.0):
+    """Send one Operation through the shared client and rate limiter, retrying 429 and 5xx
+    responses, connection errors and timeouts. A POST is only retried if the failed attempt
+    never reached the server, since repeating it could create a duplicate CI or relationship.
+    Returns the final response; raises the last error if no attempt got a response.
+    """
+    client = get_client()
+    for attempt in range(max_retries + 1):
+        _limiter.acquire()
+        response = None
+        try:
+            response = client.request(operation.method, operation.path, data=operation.data,
+                                      auth=operation.auth or client.auth)
+        except (requests.ConnectionError, requests.Timeout) as ex:
+            if attempt == max_retries or (operation.method == "POST" and not _not_sent(ex)):
+                raise
+        if response is not None:
+            if response.headers.get("X-RateLimit-Remaining") == "0":
+                _limiter.pause(_retry_delay(response, 0, 60.0))
+            if response.status_code not in RETRY_STATUSES or attempt == max_retries:
+                return response
+        delay = _retry_delay(response, attempt, backoff)
+        if response is not None and response.status_code == 429:
+            _limiter.pause(delay)
+        metrics.record_retry("freshservice", operation.method, operation.path)
+        time.sleep(delay)
+
+
+class ExecutionReport:
+    """Outcome of execute(): (operation, response) pairs that succeeded and
+    (operation, reason) pairs that failed.
+    """
+
+    def __init__(self):
+        self.succeeded = []
+        self.failed = []
+        self.lock = threading.Lock()
+
+    def record(self, operation, response=None, error=None):
+        with self.lock:
+            if error is None and response.ok:
+                self.succeeded.append((operation, response))
+            else:
+                reason = error or f"{response.status_code} {response.content[:200]!r}"
+                self.failed.append((operation, reason))
+
+    def merge(self, other):
+        """Add the outcomes of another report to this one."""
+        with self.lock:
+            self.succeeded += other.succeeded
+            self.failed += other.failed
+
+    def summary(self):
+        lines = [f"{len(self.succeeded)} succeeded, {len(self.failed)} failed"]
+        lines += [f"failed: {operation.method} {operation.path} {operation.label} - {reason}"
+                  for operation, reason in self.failed]
+        return "\n".join(lines)
+
+
+def execute(operations, workers=None, verbose=False, report=None):
+    """Send a batch of Operations with a bounded pool of workers and print a final report.
+    Returns the ExecutionReport.
+    Parameters
+    ----------
+    operations: iterable of Operation
+        Requests to send. They are independent, so completion order is not guaranteed.
+    workers: int, optional
+        Number of requests in flight at once. Default is WRITE_WORKERS.
+    verbose: bool, optional
+        If True, every response body is printed as it arrives. Default is False.
+    report: ExecutionReport, optional
+        Report that each outcome is recorded in as it arrives. Default is a new one.
+    """
+    report = ExecutionReport() if report is None else report
+
+    def run(operation):
+        try:
+            response = send(operation)
+        except Exception as ex:
+            report.record(operation, error=repr(ex))
+            return
+        report.record(operation, response)
+        if verbose:
+            print(response.content)
+
+    with ThreadPoolExecutor(max_workers=max(1, workers or WRITE_WORKERS)) as pool:
+        list(pool.map(run, operations))
+    print(report.summary())
+    return report
+
+
+class _JournalReport(ExecutionReport):
+    """ExecutionReport that also marks each outcome in an IngestJournal as it arrives."""
+
+    def __init__(self, journal, keys):
+        super().__init__()
+        self.journal = journal
+        self.keys = keys
+
+    def record(self, operation, response=None, error=None):
+        super().record(operation, response, error)
+        ok = error is None and response.ok
+        detail = None if ok else error or f"{response.status_code} {response.content[:200]!r}"
+        self.journal.mark(self.keys[id(operation)], ok, detail)
+
+
+def _file_digest(path):
+    """Returns the SHA-1 hex digest of a file's contents."""
+    digest = hashlib.sha1()
+    with open(path, "rb") as stream:
+        for block in iter(lambda: stream.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class IngestJournal:
+    """Write-ahead SQLite journal of an ingest run. Each chunk's operations are recorded before
+    any of them is sent and marked done as they succeed, so a resumed run sends only what is
+    left.
+    Parameters
+    ----------
+    path: str, optional
+        SQLite file holding the journal. Default is "ingest_journal.sqlite".
+    resume: bool, optional
+        If True, continue the run recorded in path; its parameters must match. Otherwise any
+        previous run is discarded. Default is False.
+    sources: list of str, optional
+        Input files whose contents must be unchanged for a run to resume, e.g. an export that
+        the nightly job overwrites under the same name. Their SHA-1 digests are recorded.
+    params:
+        Inputs identifying the run, e.g. the export files and chunk size.
+    """
+
+    def __init__(self, path="ingest_journal.sqlite", resume=False, sources=(), **params):
+        self.path = path
+        params["sources"] = {source: _file_digest(source) for source in sources}
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS chunks (step TEXT, chunk INTEGER, "
+                              "PRIMARY KEY (step, chunk))")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS operations (step TEXT, chunk INTEGER, "
+                              "seq INTEGER, method TEXT, path TEXT, data TEXT, auth TEXT, label TEXT, "
+                              "status TEXT, detail TEXT, PRIMARY KEY (step, chunk, seq))")
+            stored = dict(self.conn.execute("SELECT key, value FROM meta"))
+            params = json.dumps(params, sort_keys=True)
+            if resume:
+                if stored.get("params") != params:
+                    raise ValueError(f"{path} does not record an ingest of the same files, contents "
+                                     f"and options")
+            else:
+                if stored and stored.get("finished") != "1":
+                    print(f"Discarding the unfinished run recorded in {path}")
+                for table in ("meta", "chunks", "operations"):
+                    self.conn.execute(f"DELETE FROM {table}")
+                self.conn.executemany("INSERT INTO meta VALUES (?, ?)",
+                                      [("params", params), ("finished", "0"),
+                                       ("started", str(time.time()))])
+
+    @property
+    def finished(self):
+        with self.lock:
+            return self.conn.execute("SELECT value FROM meta WHERE key = 'finished'").fetchone() == ("1",)
+
+    def finish(self):
+        """Record that the run completed if every journaled operation is done. Returns the
+        number of operations that are not."""
+        with self.lock, self.conn:
+            left = self.conn.execute("SELECT count(*) FROM operations WHERE status != 'done'").fetchone()[0]
+            if not left:
+                self.conn.execute("UPDATE meta SET value = '1' WHERE key = 'finished'")
+        return left
+
+    def mark(self, key, ok, detail=None):
+        """Record the outcome of the journaled operation with this (step, chunk, seq) key."""
+        with self.lock, self.conn:
+            self.conn.execute("UPDATE operations SET status = ?, detail = ? "
+                              "WHERE step = ? AND chunk = ? AND seq = ?",
+                              ("done" if ok else "failed", detail) + tuple(key))
+
+    def journaled(self, step, chunk):
+        """Returns every Operation journaled for one chunk of a step, whatever its status."""
+        with self.lock:
+            rows = self.conn.execute("SELECT method, path, data, label FROM operations "
+                                     "WHERE step = ? AND chunk = ? ORDER BY seq", (step, chunk)).fetchall()
+        return [Operation(method, path, data, None, label) for method, path, data, label in rows]
+
+    def _plan(self, step, chunk, operations):
+        key_auth = get_client().key_auth
+        with self.lock, self.conn:
+            # a resumed chunk keeps its journaled operations and gains the freshly computed ones
+            # it does not hold yet, e.g. relations whose endpoints only exist after the resume
+            known = {(method, path, data) for method, path, data in self.conn.execute(
+                "SELECT method, path, data FROM operations WHERE step = ? AND chunk = ?", (step, chunk))}
+            added = [operation for operation in operations
+                     if (operation.method, operation.path, operation.data) not in known]
+            first = self.conn.execute("SELECT coalesce(max(seq) + 1, 0) FROM operations "
+                                      "WHERE step = ? AND chunk = ?", (step, chunk)).fetchone()[0]
+            # credentials are not written to disk, only which pair the operation used
+            self.conn.executemany(
+                "INSERT INTO operations VALUES (?, ?, ?, ?, ?, ?, ?, ?, 'planned', NULL)",
+                ((step, chunk, seq, operation.method, operation.path, operation.data,
+                  "key" if operation.auth == key_auth else None, operation.label)
+                 for seq, operation in enumerate(added, first)))
+            self.conn.execute("INSERT OR IGNORE INTO chunks VALUES (?, ?)", (step, chunk))
+            rows = self.conn.execute("SELECT seq, method, path, data, auth, label FROM operations "
+                                     "WHERE step = ? AND chunk = ? AND status != 'done' ORDER BY seq",
+                                     (step, chunk)).fetchall()
+            done = self.conn.execute("SELECT count(*) FROM operations WHERE step = ? AND chunk = ? "
+                                     "AND status = 'done'", (step, chunk)).fetchone()[0]
+        if known:
+            print(f"Resuming {step} chunk {chunk + 1}: {done} operations already sent, {len(rows)} left "
+                  f"({len(added)} newly planned)")
+        return [((step, chunk, seq), Operation(method, path, data, key_auth if auth == "key" else None, label))
+                for seq, method, path, data, auth, label in rows]
+
+    def execute(self, step, chunk, operations, workers=None, verbose=False):
+        """execute() the operations of one chunk of a step. They are journaled before any is
+        sent. When the chunk was journaled by an interrupted run, the journaled operations not
+        yet done are sent, plus any freshly computed operation the journal does not hold
+        (compared by method, path and data).
+        """
+        pending = self._plan(step, chunk, list(operations))
+        report = _JournalReport(self, {id(operation): key for key, operation in pending})
+        return execute([operation for _, operation in pending], workers, verbose, report)
+
+    def close(self):
+        self.conn.close()
+
+
+def _execute(operations, journal=None, step="", chunk=0, workers=None, verbose=False):
+    """execute() the operations, through the journal if one is given."""
+    if journal is None:
+        return execute(operations, workers, verbose)
+    return journal.execute(step, chunk, operations, workers, verbose)
 
 
 def get_tickets():
     """Returns all tickets from freshservice
     """
-    headers = {'Content-Type': 'application/json'}
-    tickets = requests.get(f"https://{fresh.domain}/helpdesk/tickets.json",
-                           headers=headers, auth=(fresh.user, fresh.password)
-                           )
-    get_calls()
+    tickets = get_client().get("/helpdesk/tickets.json")
     return json.loads(tickets.content)
 
 
@@ -96,11 +672,7 @@ def get_object(item='changes'):
         raise ValueError(' Requested item must be equal to "changes", "releases","problems",'
                          '"it_tasks", or "requesters" ')
     else:
-        headers = {'Content-Type': 'application/json'}
-        itil_object = requests.get(f"https://{fresh.domain}/itil/{item}.json",
-                                   headers=headers, auth=(fresh.user, fresh.password)
-                                   )
-        get_calls()
+        itil_object = get_client().get(f"/itil/{item}.json")
         return json.loads(itil_object.content)
 
 
@@ -114,45 +686,303 @@ def get_assoc(display_id, assoc):
         Specify if you want to view contracts or requests associated with an asset.
         Options are "contracts" or "requests"
     """
-    headers = {'Content-Type': 'application/json'}
-    data = requests.get(f"https://{fresh.domain}/api/v2/assets/{display_id}/{assoc}",
-                        headers=headers, auth=(fresh.user, fresh.password)
-                        )
-    get_calls()
+    data = get_client().get(f"/api/v2/assets/{display_id}/{assoc}")
     return json.loads(data.content)
 
 
-def get_agents():
-    """Returns all agents from freshservice
+def _memoized(key, fetch, refresh=False):
+    """Returns fetch() cached under key for METADATA_TTL seconds, shared by the whole process."""
+    with _metadata_lock:
+        entry = _metadata.get(key)
+        if refresh or entry is None or time.time() - entry[0] > METADATA_TTL:
+            entry = (time.time(), fetch())
+            _metadata[key] = entry
+        return entry[1]
+
+
+def refresh_metadata():
+    """Forget every memoized metadata response so the next call re-fetches it."""
+    with _metadata_lock:
+        _metadata.clear()
+
+
+def _get_json(path):
+    """GET a path through send(), with the shared rate limiter and retries, and return the
+    parsed body. Raises requests.HTTPError if the final response is not a success."""
+    response = send(Operation("GET", path))
+    if not response.ok:
+        raise requests.HTTPError(f"GET {path} failed: {response.status_code} {response.content[:200]!r}",
+                                 response=response)
+    return json.loads(response.content)
+
+
+def get_agents(refresh=False):
+    """Returns all agents from freshservice, memoized for METADATA_TTL seconds.
+    Parameters
+    ----------
+    refresh: bool, optional
+        If True, the memoized copy is re-fetched. Default is False.
+    """
+    return _memoized("agents", lambda: _get_json("/agents.json"), refresh)
+
+
+def get_rela_types(refresh=False):
+    """Returns relationship types from freshservice, memoized for METADATA_TTL seconds.
+    Parameters
+    ----------
+    refresh: bool, optional
+        If True, the memoized copy is re-fetched. Default is False.
+    """
+    return _memoized("relationship_types",
+                     lambda: _get_json("/cmdb/relationship_types/list.json"), refresh)
+
+
+def get_asset_types(refresh=False):
+    """Returns asset types from freshservice, memoized for METADATA_TTL seconds.
+    Parameters
+    ----------
+    refresh: bool, optional
+        If True, the memoized copy is re-fetched. Default is False.
+    """
+    return _memoized("asset_types", lambda: _get_json("/cmdb/ci_types.json"), refresh)
+
+
+def get_asset_ids():
+    """Return a dictionary consisting of Archi element types paired with their Freshservice
+    CI type IDs. CI types that match no Archi type are keyed by their name without spaces;
+    see _match_types() for how names are matched.
+    """
+    types = [item.get("ci_type", item) for item in get_asset_types()]
+    return _match_types([(item["name"], str(item["id"])) for item in types], ASSET_DICT, "CI",
+                        keep_unmatched=True)
+
+
+def _with_defaults(discover, defaults):
+    """Returns (defaults updated with discover()'s mapping, True), or (defaults, False) if
+    discovery fails."""
+    try:
+        return {**defaults, **discover()}, True
+    except (requests.RequestException, ValueError, LookupError, TypeError, AttributeError) as ex:
+        print(f"Could not discover type IDs from Freshservice ({ex!r}); using the built-in mapping.")
+        return dict(defaults), False
+
+
+def resolve_type_ids(refresh=False):
+    """Returns (element type -> CI type ID, relationship type -> relationship type ID) for the
+    current Freshservice domain. The resolved mappings are stored in TYPE_MAP_CACHE for
+    TYPE_MAP_TTL seconds, so later runs need neither the metadata calls nor the matching;
+    if either discovery fails, the built-in fallback is returned but not stored.
+    Parameters
+    ----------
+    refresh: bool, optional
+        If True, the mappings are rediscovered from Freshservice. Default is False.
+    """
+    domain = get_client().base_url
+    try:
+        with open(TYPE_MAP_CACHE) as stored:
+            cached = json.load(stored)
+    except (OSError, ValueError):
+        cached = {}
+    entry = cached.get(domain)
+    if not refresh and entry and entry.get("version") == TYPE_MAP_VERSION \
+            and time.time() - entry["saved_at"] < TYPE_MAP_TTL:
+        return entry["assets"], entry["relationships"]
+    assets, assets_found = _with_defaults(get_asset_ids, ASSET_DICT)
+    relationships, relationships_found = _with_defaults(get_rela_ids, RELA_DICT)
+    if not (assets_found and relationships_found):
+        # a fallback is not cached, so the next run tries discovery again
+        return assets, relationships
+    cached[domain] = {"version": TYPE_MAP_VERSION, "saved_at": time.time(), "assets": assets,
+                      "relationships": relationships}
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(TYPE_MAP_CACHE)), exist_ok=True)
+        with open(TYPE_MAP_CACHE, "w") as stored:
+            json.dump(cached, stored, indent=1)
+    except OSError as ex:
+        print(f"Could not save the type mapping to {TYPE_MAP_CACHE}: {ex}")
+    return assets, relationships
+
+
+def asset_type_ids(refresh=False):
+    """Returns the Archi element type -> CI type ID mapping discovered from Freshservice,
+    falling back to ASSET_DICT for types the tenant does not list. Memoized and cached on disk.
+    """
+    return _memoized("type_ids", lambda: resolve_type_ids(refresh), refresh)[0]
+
+
+def rela_type_ids(refresh=False):
+    """Returns the Archi relationship type -> relationship type ID mapping discovered from
+    Freshservice, falling back to RELA_DICT for unmatched types. Memoized and cached on disk.
+    """
+    return _memoized("type_ids", lambda: resolve_type_ids(refresh), refresh)[1]
+
+
+def _iter_pages(fetch_page, workers=1):
+    """Yield pages returned by fetch_page(page_num), in page order, up to the first empty page.
+    Parameters
+    ----------
+    fetch_page: callable
+        Takes a page number (starting at 1) and returns that page's list of records.
+    workers: int, optional
+        If greater than 1, pages are requested speculatively in windows of this many
+        concurrent requests. Pages past the first empty one are discarded. Default is 1.
+    """
+    page_num = 1
+    if workers <= 1:
+        while True:
+            page = fetch_page(page_num)
+            if not page:
+                return
+            yield page
+            page_num += 1
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while True:
+            window = pool.map(fetch_page, range(page_num, page_num + workers))
+            for page in window:
+                if not page:
+                    return
+                yield page
+            page_num += workers
+
+
+def _fetch_item_page(page_num):
+    return _get_json(f"/cmdb/items.json?page={str(page_num)}")
+
+
+def _fetch_filter_page(query, page_num):
+    return _get_json(f'/api/v2/assets?include=type_fields&query="{query}"&page={page_num}')["assets"]
+
+
+def iter_assets(workers=1):
+    """Yields every asset/CI record from freshservice as a dict, page by page, without
+    building a table. Use get_assets() when a DataFrame is needed.
+    Parameters
+    ----------
+    workers: int, optional
+        Number of pages fetched concurrently. Default is 1.
     """
-    headers = {'Content-Type': 'application/json'}
-    agents = requests.get(f"https://{fresh.domain}/agents.json", headers=headers,
-                          auth=(fresh.user, fresh.password)
-                          )
-    get_calls()
-    return json.loads(agents.content)
+    for page in _iter_pages(_fetch_item_page, workers):
+        yield from page
+
+
+# records held as dicts at once while a table is built; the rest are already columns
+FRAME_BATCH = 5000
+
+
+def _records_frame(records):
+    """Returns a DataFrame of the dicts yielded by records, building it FRAME_BATCH records at
+    a time and concatenating once, so the whole export is never held as dicts."""
+    frames, batch = [], []
+    for record in records:
+        batch.append(record)
+        if len(batch) == FRAME_BATCH:
+            frames.append(pd.DataFrame(batch))
+            batch = []
+    if batch or not frames:
+        frames.append(pd.DataFrame(batch))
+    return frames[0] if len(frames) == 1 else pd.concat(frames, ignore_index=True)
 
 
-def get_rela_types():
-    """Returns relationship types from freshservice
+def iter_filtered_assets(query="", workers=1):
+    """Yields the asset records matching a filter_assets() query as dicts, page by page.
+    Parameters
+    ----------
+    query: str
+        See filter_assets().
+    workers: int, optional
+        Number of pages fetched concurrently. Default is 1.
     """
-    name = requests.get(f"https://{fresh.domain}/cmdb/relationship_types/list.json",
-                        auth=(fresh.user, fresh.password)
-                        )
-    get_calls()
-    return json.loads(name.content)
+    for page in _iter_pages(lambda page_num: _fetch_filter_page(query, page_num), workers):
+        yield from page
+
+
+def _fetch_relationships(display_id):
+    return _get_json(f"/cmdb/items/{str(display_id)}/relationships.json")
 
 
-def get_asset_types():
-    """Returns asset types from freshservice
+def _load_checkpoint(checkpoint, domain):
+    """Returns the display_id -> relationships.json data stored in a fetch_relationships()
+    checkpoint for this domain, or None if there is no usable checkpoint."""
+    if not checkpoint or not os.path.exists(checkpoint) \
+            or time.time() - os.path.getmtime(checkpoint) >= CHECKPOINT_MAX_AGE:
+        return None
+    results = {}
+    with open(checkpoint) as stored:
+        try:
+            header = json.loads(stored.readline())
+        except ValueError:
+            header = None
+        if not isinstance(header, dict) or header.get("domain") != domain:
+            print(f"Ignoring {checkpoint}: it was not written for {domain}")
+            return None
+        for line in stored:
+            try:
+                display_id, relationship_data = json.loads(line)
+            except ValueError:
+                continue  # a blank line, or a line cut short by the interruption
+            results[display_id] = relationship_data
+    return results
+
+
+def fetch_relationships(display_ids, workers=8, checkpoint=RELATIONSHIP_CHECKPOINT):
+    """Returns a dict of display_id -> relationships.json data for every given CI, fetched
+    by a bounded pool of workers through send(), so they share the rate limiter and retries.
+    Raises requests.HTTPError if a CI's relationships cannot be fetched.
+    Parameters
+    ----------
+    display_ids: iterable
+        display_ids of the CIs whose relationships are fetched.
+    workers: int, optional
+        Number of requests in flight at once. Default is 8.
+    checkpoint: str, optional
+        JSON-lines file that each result is appended to as it arrives, headed by the
+        Freshservice domain. If a run is interrupted, the next call for the same domain picks
+        up the results stored there (if the file is less than CHECKPOINT_MAX_AGE seconds old)
+        and only fetches the rest. The file is removed once every CI has been fetched. Pass
+        None to disable. Default is RELATIONSHIP_CHECKPOINT.
     """
-    name = requests.get(f"https://{fresh.domain}/cmdb/ci_types.json",
-                        auth=(fresh.user, fresh.password))
-    get_calls()
-    return json.loads(name.content)
+    display_ids = [str(display_id) for display_id in display_ids]
+    domain = get_client().base_url
+    stored = _load_checkpoint(checkpoint, domain)
+    results = {}
+    if stored is not None:
+        wanted = set(display_ids)
+        results = {display_id: data for display_id, data in stored.items() if display_id in wanted}
+        print(f"Resuming relationship fetch: {len(results)} CIs already fetched")
+    pending = [display_id for display_id in display_ids if display_id not in results]
+    total = len(display_ids)
+    step = max(1, total // 20)
+    lock = threading.Lock()
 
+    def fetch(display_id):
+        relationship_data = _fetch_relationships(display_id)
+        # checkpoint from the worker, so requests still in flight when another fails are kept
+        with lock:
+            results[display_id] = relationship_data
+            log.write(json.dumps([display_id, relationship_data]) + "\n")
+            log.flush()
+            done = len(results)
+        if done % step == 0 or done == total:
+            print(f"Fetched relationships for {done}/{total} CIs")
 
-def get_assets(rela=False, dwnl_csv=False):
+    with open(checkpoint or os.devnull, "a" if stored is not None else "w") as log:
+        if stored is None:
+            log.write(json.dumps({"domain": domain}) + "\n")
+        else:
+            log.write("\n")  # never continue a line an interrupted run left unfinished
+        pool = ThreadPoolExecutor(max_workers=max(1, workers))
+        try:
+            for future in as_completed([pool.submit(fetch, display_id) for display_id in pending]):
+                future.result()
+        finally:
+            # on an error or Ctrl-C, drop the queued fetches instead of sending them unrecorded
+            pool.shutdown(cancel_futures=True)
+    if checkpoint and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    return results
+
+
+def get_assets(rela=False, dwnl_csv=False, workers=1, rela_workers=8):
     """Returns all assets/CIs from freshservice
     Parameters
     ----------
@@ -161,127 +991,584 @@ def get_assets(rela=False, dwnl_csv=False):
     dwnl_csv: bool, optional
         If True, CSV of assets is downloaded to current directory. Created file name is
         "freshservice_export.csv".
+    workers: int, optional
+        Number of pages fetched concurrently. Default is 1 (one page at a time).
+    rela_workers: int, optional
+        With rela=True, number of relationship requests in flight at once. Interrupted
+        fetches resume from a checkpoint; see fetch_relationships(). Default is 8.
     """
-    asset_table = pd.DataFrame()
-    page_num = 1
-    pages_left = True
-    while pages_left:
-        name = requests.get(f"https://{fresh.domain}/cmdb/items.json?page={str(page_num)}",
-                            auth=(fresh.user, fresh.password)
-                            )
-        data_content = json.loads(name.content)
-        page_num += 1
-        asset_data = pd.DataFrame(data_content)
-        asset_table = asset_table.append(asset_data, ignore_index=True)
-        if len(data_content) == 0:
-            pages_left = False
+    asset_table = _records_frame(iter_assets(workers))
     if rela:
-        asset_table["relationship_data"] = numpy.nan
-        for index, row in asset_table.iterrows():
-            request = requests.get(f"https://{fresh.domain}/cmdb/items/{str(row['display_id'])}/relationships.json",
-                                       auth=(fresh.user, fresh.password)
-                                  )
-            get_calls()
-            relationship_data = json.loads(request.content)
-            asset_table.loc[index, "relationship_data"] = relationship_data
-        if dwnl_csv:
-            asset_table.to_csv("freshservice_export.csv", index=False)
-            return asset_table
-    else:
-        if dwnl_csv:
-            asset_table.to_csv("freshservice_export.csv", index=False)
-            return asset_table
-    return asset_table      
+        if asset_table.empty:
+            asset_table["relationship_data"] = numpy.nan
+        else:
+            relationship_data = fetch_relationships(asset_table["display_id"], rela_workers)
+            asset_table["relationship_data"] = [relationship_data[str(display_id)]
+                                                for display_id in asset_table["display_id"]]
+    if dwnl_csv:
+        asset_table.to_csv("freshservice_export.csv", index=False)
+    return asset_table
 
 
-def add_update_assets(file="", filetype = ""):
-    """Adds or updates assets/CIs in freshservice CMDB. Assets not present in the upload
-    file, but present in the CMDB will be deleted from the CMDB.
+class SnapshotCache:
+    """SQLite store of CMDB snapshots (get_assets() records) keyed by Freshservice domain.
     Parameters
     ----------
-    csv: str, optional
-        Specifies the exported Archi file that contains assets/CIs that should be uploaded.
-        Default value is "elements.csv".
-    """
-    if filetype == "csv": 
-        csv_data = pd.read_csv(file)
-    if filetype == "xlsx":
-        csv_data = pd.read_excel(file, usecols = "B:E")
-    upload_data = pd.DataFrame(columns=["Name", "Type", "GUID", "Documentation"])
-    # cnx = sqlite3.connect('/Users/audreykoziol/Desktop/freshservice/Untitled.sqlite')
-    # csv_data = pd.read_sql_query("SELECT * FROM elements", cnx)
-    # print(csv_data['class'])
-    names = [item for item in csv_data.Name]
-    types = [ASSET_DICT[item] for item in csv_data.Type]
-    guids = [item for item in csv_data.ID]
-    documentation = [item for item in csv_data.Documentation]
-    upload_data.Name = names
-    upload_data['Name'].str.replace(r"\(.*\)", "")
-    upload_data.Type = types
-    upload_data.GUID = guids
-    upload_data.Documentation = documentation
-    current_assets = get_assets()
-    print(current_assets.empty)
-    if current_assets.empty == False:
-        #for index, row in current_assets.iterrows():
-            #if row["asset_tag"] in list(upload_data['GUID']):
-                #pass
-            #else:
-                #delete_asset(row["display_id"])
-        for index, row in upload_data.iterrows():
-            dump = {'cmdb_config_item':
-                    {'name': re.sub(r'\([^)]*\)', '', str(row.Name)),
-                     'ci_type_id': str(row.Type),
-                     'description':str(row.Documentation),
-                     'asset_tag':str(row.GUID),
-                     'level_field_attributes':
-                      {f'file_imported_from_{row.Type}': file
-                      }
-                    }
-                   }
-            data = json.dumps(dump)
-            headers = {'Content-Type': 'application/json'}
-            if current_assets['asset_tag'].str.contains(row["GUID"]).any():
-                if str(row["Documentation"]).strip() == current_assets[current_assets['asset_tag']
-                        .str.match(row["GUID"])]['description'].values[0] \
-                        and row["Type"] == current_assets[current_assets['asset_tag'].str
-                        .match(row["GUID"])]['ci_type_id'].values[0] \
-                        and re.sub(r'\([^)]*\)', '', str(row.Name)).strip() == \
-                        current_assets[current_assets['asset_tag'].str.match(row["GUID"])]['name'].values[0]:
-                    pass
-                else:
-                    item_id = current_assets[current_assets['asset_tag'].str.match(row["GUID"])]['display_id'].values[0]
-                    response = requests.put(f"https://{fresh.domain}/cmdb/items/{item_id}.json",
-                                            headers=headers, data=data, auth=(fresh.user, fresh.password)
-                                            )
-                    print(response.content)
+    path: str, optional
+        SQLite file. Default is "snapshots.sqlite" under CACHE_DIR.
+    ttl: float, optional
+        Seconds after a full download before the next read downloads everything again.
+        Default is SNAPSHOT_TTL.
+    """
+
+    def __init__(self, path=None, ttl=SNAPSHOT_TTL):
+        self.path = path or os.path.join(CACHE_DIR, "snapshots.sqlite")
+        self.ttl = ttl
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with closing(self._connect()) as conn, conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS snapshots (domain TEXT PRIMARY KEY, "
+                         "fetched_at REAL, high_water TEXT, stale INTEGER)")
+            conn.execute("CREATE TABLE IF NOT EXISTS items (domain TEXT, display_id TEXT, "
+                         "record TEXT, PRIMARY KEY (domain, display_id))")
+
+    def _connect(self):
+        return sqlite3.connect(self.path)
+
+    def load(self, domain):
+        """Returns (fetched_at, high_water, stale, records) for a domain, or None if not cached."""
+        with closing(self._connect()) as conn:
+            meta = conn.execute("SELECT fetched_at, high_water, stale FROM snapshots WHERE domain = ?",
+                                (domain,)).fetchone()
+            if meta is None:
+                return None
+            records = [json.loads(record) for (record,) in
+                       conn.execute("SELECT record FROM items WHERE domain = ?", (domain,))]
+        return meta[0], meta[1], bool(meta[2]), records
+
+    def store(self, domain, records, merge=False):
+        """Save records for a domain, replacing the cached snapshot unless merge is True, in
+        which case records are upserted by display_id and the download time is kept.
+        """
+        with closing(self._connect()) as conn, conn:
+            if not merge:
+                conn.execute("DELETE FROM items WHERE domain = ?", (domain,))
+            conn.executemany("INSERT OR REPLACE INTO items VALUES (?, ?, ?)",
+                             ((domain, str(record["display_id"]), json.dumps(record))
+                              for record in records))
+            high_water = max((_utc_timestamp(record.get("updated_at")) for record in records),
+                             default="")
+            if merge:
+                conn.execute("UPDATE snapshots SET high_water = max(high_water, ?), stale = 0 "
+                             "WHERE domain = ?", (high_water, domain))
+            else:
+                conn.execute("INSERT OR REPLACE INTO snapshots VALUES (?, ?, ?, 0)",
+                             (domain, time.time(), high_water))
+
+    def mark_stale(self, domain):
+        """Make the next read refresh the domain incrementally, e.g. after creates/updates."""
+        with closing(self._connect()) as conn, conn:
+            conn.execute("UPDATE snapshots SET stale = 1 WHERE domain = ?", (domain,))
+
+    def discard(self, domain, display_ids):
+        """Remove deleted items from a cached snapshot."""
+        with closing(self._connect()) as conn, conn:
+            conn.executemany("DELETE FROM items WHERE domain = ? AND display_id = ?",
+                             ((domain, str(display_id)) for display_id in display_ids))
+
+    def invalidate(self, domain=None):
+        """Drop the cached snapshot of a domain, or of every domain."""
+        with closing(self._connect()) as conn, conn:
+            if domain is None:
+                conn.execute("DELETE FROM items")
+                conn.execute("DELETE FROM snapshots")
             else:
-                response = requests.post(f"https://{fresh.domain}/cmdb/items.json",
-                                         headers=headers, data=data, auth=(fresh.user, fresh.password)
-                                         )
-                print(response.content)
+                conn.execute("DELETE FROM items WHERE domain = ?", (domain,))
+                conn.execute("DELETE FROM snapshots WHERE domain = ?", (domain,))
+
+
+def _utc_timestamp(value):
+    """Normalise an ISO timestamp with any UTC offset to a sortable UTC string."""
+    if not value:
+        return ""
+    parsed = dt.datetime.fromisoformat(str(value).replace("Z", "+00:00"))
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(dt.timezone.utc).replace(tzinfo=None)
+    return parsed.isoformat()
+
+
+_snapshot_cache = None
+
+
+def configure_snapshot_cache(path=None, ttl=SNAPSHOT_TTL, enabled=True):
+    """Replace the SnapshotCache used by get_snapshot(), or disable caching with enabled=False.
+    """
+    global _snapshot_cache
+    _snapshot_cache = SnapshotCache(path, ttl) if enabled else False
+    return _snapshot_cache
+
+
+def _snapshot_store():
+    global _snapshot_cache
+    if _snapshot_cache is None:
+        _snapshot_cache = SnapshotCache()
+    return _snapshot_cache
+
+
+def _from_v2_asset(asset):
+    """Map an /api/v2/assets record onto the /cmdb/items.json fields the snapshot uses."""
+    record = {key: value for key, value in asset.items() if key != "asset_type_id"}
+    if "asset_type_id" in asset:
+        record["ci_type_id"] = asset["asset_type_id"]
+    return record
+
+
+def get_snapshot(refresh=None, workers=None):
+    """Returns the CMDB snapshot, as get_assets() does, served from the on-disk SnapshotCache.
+    Parameters
+    ----------
+    refresh: str, optional
+        None uses the cached copy while it is younger than the cache TTL, refreshing it
+        incrementally if writes marked it stale. "incremental" pulls only items whose
+        updated_at is past the cached high-water mark through filter_assets(). "full"
+        downloads everything. An expired or missing cache is always downloaded in full.
+    workers: int, optional
+        Number of pages fetched concurrently. Default is READ_WORKERS.
+    """
+    workers = workers or READ_WORKERS
+    cache = _snapshot_store()
+    if not cache:
+        return get_assets(workers=workers)
+    domain = get_client().base_url
+    cached = cache.load(domain)
+    if refresh == "full" or cached is None or time.time() - cached[0] > cache.ttl:
+        records = list(iter_assets(workers))
+        cache.store(domain, records)
+        return pd.DataFrame(records)
+    fetched_at, high_water, stale, records = cached
+    if refresh == "incremental" or stale:
+        # the filter API only compares dates, so re-read the high-water day and merge
+        since = (high_water or "1970-01-01")[:10]
+        changed = [_from_v2_asset(asset) for asset in
+                   iter_filtered_assets(f"updated_at:>%27{since}%27", workers)]
+        by_id = {str(record["display_id"]): record for record in records}
+        for asset in changed:
+            by_id.setdefault(str(asset["display_id"]), {}).update(asset)
+        merged = [by_id[str(asset["display_id"])] for asset in changed]
+        cache.store(domain, merged, merge=True)
+        records = list(by_id.values())
+    return pd.DataFrame(records)
+
+
+def invalidate_snapshot(display_ids=None):
+    """Tell the snapshot cache the CMDB changed: with display_ids, those deleted items are
+    dropped from the cache; without, the cache is marked stale for an incremental refresh.
+    """
+    cache = _snapshot_store()
+    if not cache:
+        return
+    domain = get_client().base_url
+    if display_ids is None:
+        cache.mark_stale(domain)
     else:
-        for index, row in upload_data.iterrows():
-            dump = {'cmdb_config_item':
-                    {'name': re.sub(r'\([^)]*\)', '', str(row.Name)),
-                     'ci_type_id': str(row.Type),
-                     'description':str(row.Documentation),
-                     'asset_tag':str(row.GUID),
-                     'level_field_attributes':
-                      {f'file_imported_from_{row.Type}': file
-                      }
-                    }
-                   }
-            data = json.dumps(dump)
-            headers = {'Content-Type': 'application/json'}
-            response = requests.post(f"https://{fresh.domain}/cmdb/items.json",
-                                     headers=headers, data=data, auth=(fresh.user, fresh.password)
-                                     )
-            print(response.content)
+        cache.discard(domain, display_ids)
+
+
+class AssetIndex:
+    """In-memory index over a get_assets() snapshot for exact, constant-time lookups.
+    Parameters
+    ----------
+    asset_table: DataFrame
+        CMDB snapshot as returned by get_assets().
+    """
+
+    def __init__(self, asset_table):
+        self.by_tag = {}
+        self.by_name = {}
+        self.by_display_id = {}
+        records = [] if asset_table.empty else asset_table.to_dict("records")
+        for record in records:
+            tag = record.get("asset_tag")
+            if isinstance(tag, str) and tag:
+                self.by_tag.setdefault(tag, record)
+            self.by_name.setdefault(str(record.get("name")).strip(), []).append(record)
+            self.by_display_id[str(record.get("display_id"))] = record
+
+    def __len__(self):
+        return len(self.by_display_id)
+
+    def tag(self, asset_tag):
+        """Returns the record with this asset_tag (Archi GUID), or None."""
+        return self.by_tag.get(str(asset_tag))
+
+    def name(self, name):
+        """Returns the list of records with this name; names are not unique in the CMDB."""
+        return self.by_name.get(str(name).strip(), [])
+
+    def display_id(self, display_id):
+        """Returns the record with this display_id, or None."""
+        return self.by_display_id.get(str(display_id))
+
+
+Change = namedtuple("Change", ["action", "guid", "display_id", "name", "ci_type_id",
+                               "description", "diff"])
+Change.__doc__ = """One planned CMDB operation. action is "create", "update", "unchanged" or
+"orphaned"; diff maps each changed field to its (CMDB value, upload value) pair."""
+
+_PLAN_FIELDS = {"name": "new_name", "ci_type_id": "new_type", "description": "new_description"}
+
+
+class ChangePlan:
+    """The creates, updates, no-ops and CMDB-only items computed by plan_changes().
+    Parameters
+    ----------
+    changes: list of Change
+        The planned changes.
+    unchanged: int, optional
+        Number of further unchanged items counted without a Change each, as add_update_assets()
+        does for chunked files. Default is 0.
+    """
+
+    def __init__(self, changes, unchanged=0):
+        self.changes = changes
+        self.creates = [change for change in changes if change.action == "create"]
+        self.updates = [change for change in changes if change.action == "update"]
+        self.unchanged = [change for change in changes if change.action == "unchanged"]
+        self.orphaned = [change for change in changes if change.action == "orphaned"]
+        self.unchanged_count = len(self.unchanged) + unchanged
+
+    def summary(self, detail=False):
+        """Returns a printable summary of the plan.
+        Parameters
+        ----------
+        detail: bool, optional
+            If True, every create/update/orphan is listed with its field-level diff.
+            Default is False.
+        """
+        lines = [f"{len(self.creates)} to create, {len(self.updates)} to update, "
+                 f"{self.unchanged_count} unchanged, {len(self.orphaned)} only in the CMDB"]
+        if detail:
+            for change in self.creates:
+                lines.append(f"+ {change.guid} {change.name}")
+            for change in self.updates:
+                fields = ", ".join(f"{field}: {old!r} -> {new!r}"
+                                   for field, (old, new) in change.diff.items())
+                lines.append(f"~ {change.guid} #{change.display_id} {fields}")
+            for change in self.orphaned:
+                lines.append(f"? {change.guid} #{change.display_id} {change.name}")
+        return "\n".join(lines)
+
 
-def add_rela(rela_data="relations.csv", asset_data="elements.csv", filetype=""):
+def _id_string(value):
+    """Returns an ID as the string the API uses. Pandas stores an integer column holding any
+    null as float, so 12.0 becomes "12"; a missing ID becomes ""."""
+    if isinstance(value, float):
+        return "" if value != value else str(int(value)) if value.is_integer() else str(value)
+    return "" if value is None else str(value)
+
+
+def _tagged_snapshot(current_assets):
+    """Returns the planner's view of a snapshot: the CMDB items with an asset_tag, as strings."""
+    snapshot_columns = ["asset_tag", "display_id", "name", "ci_type_id", "description"]
+    if current_assets.empty:
+        return pd.DataFrame(columns=snapshot_columns, dtype=str)
+    snapshot = current_assets.reindex(columns=snapshot_columns)
+    tagged = snapshot["asset_tag"].map(lambda tag: isinstance(tag, str) and tag != "")
+    snapshot = snapshot[tagged].assign(description=lambda frame: frame["description"].fillna(""),
+                                       display_id=lambda frame: frame["display_id"].map(_id_string),
+                                       ci_type_id=lambda frame: frame["ci_type_id"].map(_id_string))
+    return snapshot.astype(str).drop_duplicates("asset_tag")
+
+
+def _orphaned_changes(snapshot):
+    """Returns "orphaned" Changes for every row of a _tagged_snapshot() frame."""
+    return [Change("orphaned", row.asset_tag, row.display_id, row.name, row.ci_type_id,
+                   row.description, {}) for row in snapshot.itertuples(index=False)]
+
+
+def plan_changes(upload_data, current_assets, orphaned=True):
+    """Compare an upload frame with a CMDB snapshot in one merge on GUID/asset_tag.
+    Parameters
+    ----------
+    upload_data: DataFrame
+        Rows with "Name", "Type" (ci_type_id), "GUID" and "Documentation" columns.
+    current_assets: DataFrame
+        CMDB snapshot as returned by get_assets(). Items without an asset_tag are ignored.
+    orphaned: bool, optional
+        If False, snapshot items missing from upload_data are left out of the plan, e.g. when
+        upload_data is one chunk of a larger file. Default is True.
+    """
+    upload = normalize_upload(upload_data).drop_duplicates("GUID", keep="last")
+    snapshot = _tagged_snapshot(current_assets)
+    merged = upload.merge(snapshot, how="outer" if orphaned else "left", left_on="GUID",
+                          right_on="asset_tag", indicator=True)
+    both = merged["_merge"] == "both"
+    compared = merged.assign(new_description=merged["new_description"].str.strip())
+    differs = pd.DataFrame({field: compared[field] != compared[column]
+                            for field, column in _PLAN_FIELDS.items()})
+    changed = both & differs.any(axis=1)
+    action = numpy.select([merged["_merge"] == "left_only", changed, both],
+                          ["create", "update", "unchanged"], default="orphaned")
+    changes = []
+    for row, row_action, row_differs in zip(merged.itertuples(index=False), action,
+                                            differs.itertuples(index=False)):
+        if row_action == "orphaned":
+            changes.append(Change("orphaned", row.asset_tag, row.display_id, row.name,
+                                  row.ci_type_id, row.description, {}))
+            continue
+        diff = {}
+        if row_action == "update":
+            diff = {field: (getattr(row, field), getattr(row, column))
+                    for (field, column), is_different in zip(_PLAN_FIELDS.items(), row_differs)
+                    if is_different}
+        display_id = None if row_action == "create" else row.display_id
+        changes.append(Change(row_action, row.GUID, display_id, row.new_name, row.new_type,
+                              row.new_description, diff))
+    return ChangePlan(changes)
+
+
+if orjson is not None:
+    def _encode_json(value):
+        return orjson.dumps(value).decode()
+else:
+    _encode_json = json.dumps
+
+
+class PayloadBuilder:
+    """Serializes the cmdb_config_item payloads of planned Changes. The JSON for each CI
+    type's fixed part (ci_type_id and level_field_attributes) is rendered once, so each
+    payload only encodes its name, description and asset_tag. orjson is used when installed.
+    Parameters
+    ----------
+    level_field_attributes: callable
+        Takes a ci_type_id and returns the type-specific fields sent with the item, e.g.
+        {f"file_imported_from_{ci_type_id}": file}.
+    """
+
+    def __init__(self, level_field_attributes):
+        self.level_field_attributes = level_field_attributes
+        self.templates = {}
+
+    def template(self, ci_type_id):
+        """Returns the rendered opening of a payload for a CI type."""
+        template = self.templates.get(ci_type_id)
+        if template is None:
+            template = ('{"cmdb_config_item": {"ci_type_id": ' + _encode_json(str(ci_type_id))
+                        + ', "level_field_attributes": '
+                        + _encode_json(self.level_field_attributes(ci_type_id)) + ', "name": ')
+            self.templates[ci_type_id] = template
+        return template
+
+    def build(self, change):
+        """Returns the JSON payload that creates or updates the CI of a Change."""
+        return (self.template(change.ci_type_id) + _encode_json(change.name)
+                + ', "description": ' + _encode_json(change.description)
+                + ', "asset_tag": ' + _encode_json(change.guid) + '}}')
+
+
+def apply_plan(plan, level_field_attributes, verbose=False, workers=None, journal=None, chunk=0):
+    """Send the creates and updates of a ChangePlan to the CMDB. Returns the ExecutionReport.
+    Parameters
+    ----------
+    plan: ChangePlan
+        Plan returned by plan_changes().
+    level_field_attributes: callable
+        Takes a ci_type_id and returns the type-specific fields sent with the item.
+    verbose: bool, optional
+        If True, every payload and response is printed. Default is False.
+    workers: int, optional
+        Number of requests in flight at once. Default is WRITE_WORKERS.
+    journal: IngestJournal, optional
+        Journal the operations are recorded in, as chunk number chunk of its "assets" step.
+    """
+    builder = PayloadBuilder(level_field_attributes)
+    operations = []
+    for change in plan.creates + plan.updates:
+        data = builder.build(change)
+        if verbose:
+            print(data)
+        if change.action == "create":
+            operations.append(Operation("POST", "/cmdb/items.json", data, label=change.guid))
+        else:
+            operations.append(Operation("PUT", f"/cmdb/items/{change.display_id}.json", data,
+                                        label=change.guid))
+    return _execute(operations, journal, "assets", chunk, workers, verbose)
+
+
+ELEMENT_COLUMNS = ["ID", "Type", "Name", "Documentation"]
+RELATION_COLUMNS = ["Type", "Source", "Target"]
+
+
+def read_export(file, filetype, columns, chunksize=None, excel_columns=None, table=None,
+                types=None):
+    """Yields an Archi export as DataFrames of at most chunksize rows, parsing only the given
+    columns, as strings.
+    Parameters
+    ----------
+    file: str
+        Exported Archi file, or the Archi SQLite database for filetype "db".
+    filetype: str
+        "csv", "xlsx" or "db". CSV files and databases are streamed; XLSX files are read
+        whole and then split.
+    columns: list
+        Column names to keep.
+    chunksize: int, optional
+        Rows per chunk. Default is None (the whole file in one frame).
+    excel_columns: str, optional
+        Spreadsheet column range holding the export, e.g. "B:E".
+    table: str, optional
+        For filetype "db", the table to read ("elements" or "relations").
+    types: iterable, optional
+        For filetype "db", only rows whose Type is listed are read.
+    """
+    if filetype == "csv":
+        if chunksize:
+            yield from pd.read_csv(file, usecols=columns, dtype=str, chunksize=chunksize)
+        else:
+            yield pd.read_csv(file, usecols=columns, dtype=str)
+    elif filetype == "xlsx":
+        data = pd.read_excel(file, usecols=excel_columns, dtype=str)[columns]
+        step = chunksize or max(len(data), 1)
+        for start in range(0, len(data), step):
+            yield data.iloc[start:start + step]
+    elif filetype == "db":
+        yield from read_archi_db(file, table, columns, chunksize, types)
+    else:
+        raise ValueError('filetype must be "csv", "xlsx" or "db"')
+
+
+def read_archi_db(database, table, columns, chunksize=None, types=None):
+    """Yields rows of a table in the Archi SQLite database (e.g. LSST_archi_tool.db.sav) as
+    DataFrames of strings, reading only the given columns through a streaming cursor.
+    Parameters
+    ----------
+    database: str
+        Path of the Archi SQLite database.
+    table: str
+        "elements" or "relations".
+    columns: list
+        Column names to select.
+    chunksize: int, optional
+        Rows per DataFrame. Default is None (the whole table in one frame).
+    types: iterable, optional
+        If given, only rows whose Type is listed are read.
+    """
+    if table not in ("elements", "relations"):
+        raise ValueError('table must be "elements" or "relations"')
+    selected = ", ".join('"{}"'.format(column) for column in columns)
+    query = f"SELECT {selected} FROM {table}"
+    parameters = []
+    if types is not None:
+        parameters = [str(item) for item in types]
+        query += f' WHERE "Type" IN ({", ".join("?" * len(parameters))})'
+    with closing(sqlite3.connect(f"file:{database}?mode=ro", uri=True)) as conn:
+        cursor = conn.execute(query, parameters)
+        while True:
+            rows = cursor.fetchmany(chunksize) if chunksize else cursor.fetchall()
+            if not rows:
+                return
+            # NULL (e.g. an element without documentation) is read as "", as in CSV exports
+            yield pd.DataFrame(rows, columns=columns).fillna("").astype(str)
+            if not chunksize:
+                return
+
+
+def _upload_frame(elements, type_ids):
+    """Returns the Name/Type/GUID/Documentation frame uploaded for a frame of Archi elements.
+    Elements whose type has no CI type ID are reported and left out.
+    """
+    types = elements["Type"].map(type_ids)
+    unknown = types.isna()
+    if unknown.any():
+        print(f"Skipping {int(unknown.sum())} elements of unknown type: "
+              f"{', '.join(sorted(elements.loc[unknown, 'Type'].astype(str).unique()))}")
+    return pd.DataFrame({"Name": elements["Name"], "Type": types, "GUID": elements["ID"],
+                         "Documentation": elements["Documentation"]})[~unknown]
+
+
+def add_update_assets(file="", filetype = "", dry_run=False, chunksize=None, journal=None):
+    """Adds or updates assets/CIs in freshservice CMDB. Assets present in the CMDB but not in
+    the upload file are reported, not deleted. Returns the ChangePlan that was applied; its
+    unchanged items are only counted, so it stays small however large the file is.
+    Parameters
+    ----------
+    file: str
+        Specifies the exported Archi file that contains assets/CIs that should be uploaded.
+    filetype: str
+        "csv", "xlsx", or "db" if file is the Archi SQLite database.
+    dry_run: bool, optional
+        If True, the plan is printed in full but nothing is sent to the CMDB. Default is False.
+    chunksize: int, optional
+        If given, the file is read, diffed and written this many rows at a time, so memory
+        stays flat and writes start before the whole file is parsed. Default is None.
+    journal: IngestJournal, optional
+        If given, each chunk's writes are journaled before they are sent, and chunks already
+        in the journal only send the writes it has not marked done. Default is None.
+    """
+    type_ids = asset_type_ids()
+    with metrics.phase("fetch snapshot"):
+        snapshot = _tagged_snapshot(get_snapshot())
+    if not dry_run:
+        # mark the cache stale before writing, so even an interrupted run refreshes it
+        invalidate_snapshot()
+    changes = []
+    unchanged = 0
+    seen = set()
+    for chunk, elements in enumerate(read_export(file, filetype, ELEMENT_COLUMNS, chunksize,
+                                                 excel_columns="B:E", table="elements", types=type_ids)):
+        with metrics.phase("diff"):
+            upload_data = _upload_frame(elements, type_ids)
+            seen.update(upload_data["GUID"].astype(str))
+            chunk_plan = plan_changes(upload_data, snapshot[snapshot["asset_tag"].isin(upload_data["GUID"])],
+                                      orphaned=False)
+        changes += chunk_plan.creates + chunk_plan.updates
+        unchanged += len(chunk_plan.unchanged)
+        if not dry_run:
+            with metrics.phase("write"):
+                apply_plan(chunk_plan, lambda ci_type: {f'file_imported_from_{ci_type}': file},
+                           journal=journal, chunk=chunk)
+    plan = ChangePlan(changes + _orphaned_changes(snapshot[~snapshot["asset_tag"].isin(seen)]), unchanged)
+    print(plan.summary(detail=dry_run))
+    return plan
+
+
+def _current_edges(asset_table):
+    """Returns the forward relationships held in a get_assets(rela=True) snapshot as a
+    DataFrame of source_id, target_id, rela_type_id and relationship_id.
+    """
+    columns = ["source_id", "target_id", "rela_type_id", "relationship_id"]
+    if asset_table.empty or "relationship_data" not in asset_table:
+        return pd.DataFrame(columns=columns)
+    edges = []
+    for display_id, relationships in zip(asset_table["display_id"], asset_table["relationship_data"]):
+        if isinstance(relationships, dict):
+            relationships = relationships.get("relationships", [])
+        if not isinstance(relationships, list):
+            continue
+        for entry in relationships:
+            target = entry.get("config_item") or {}
+            if (entry.get("relationship_type", "forward_relationship") != "forward_relationship"
+                    or target.get("display_id") is None):
+                continue
+            edges.append((int(display_id), int(target["display_id"]),
+                          str(entry.get("relationship_type_id")), entry.get("id")))
+    return pd.DataFrame(edges, columns=columns)
+
+
+def _associated_edges(operations):
+    """Yields the (source_id, target_id, rela_type_id) edges posted by associate.json Operations."""
+    for operation in operations:
+        if operation.method == "POST" and operation.path.endswith("/associate.json"):
+            source_id = int(operation.path.split("/")[3])
+            data = json.loads(operation.data)
+            for target_id in data["type_id"]:
+                yield source_id, int(target_id), str(data["relationship_type_id"])
+
+
+def add_rela(rela_data="relations.csv", asset_data="elements.csv", filetype="",
+             reject_file="rejected_relations.csv", incremental=False, chunksize=None, journal=None):
     """Add relationships to assets in freshservice CMDB. Assets must exist in the CMDB
-    for a relationship to be created.
+    for a relationship to be created; endpoints are matched on asset_tag (the Archi GUID).
+    All targets sharing a source and relationship type are associated in a single call.
     Parameters
     ----------
     rela_data: str, optional 
@@ -290,55 +1577,137 @@ def add_rela(rela_data="relations.csv", asset_data="elements.csv", filetype=""):
     asset_data: str, optional
         Specifies the exported Archi file that contains assets/CIs that were uploaded to 
         Freshservice. Default value is "elements.csv".
+    filetype: str
+        "csv", "xlsx", or "db" if both files are the Archi SQLite database.
+    reject_file: str, optional
+        CSV file that relationships with an unresolved endpoint or type are written to,
+        with the reason. It is removed at the start of every run. Default value is
+        "rejected_relations.csv".
+    incremental: bool, optional
+        If True, the current relationships of this file's CIs are fetched and only missing
+        edges are associated; edges between CIs of this elements file that are no longer in the
+        relations file are detached. Default is False (associate every edge).
+    chunksize: int, optional
+        If given, the relations file is read and sent this many rows at a time. Default is None.
+    journal: IngestJournal, optional
+        If given, each chunk's calls are journaled before they are sent, and chunks already in
+        the journal only send the calls it has not marked done. Default is None.
    """
-    if filetype == "csv":
-        rela_data = pd.read_csv(rela_data)
-        asset_data = pd.read_csv(asset_data)
-    if filetype == "xlsx":
-        rela_data = pd.read_excel(rela_data, usecols = "B:G")
-        asset_data = pd.read_excel(asset_data, usecols = "B:E")
-    new_data = pd.DataFrame(columns=["Name", "Type", "GUID"])
-    new_data.Name = [re.sub(r'\([^)]*\)', '', str(item)) for item in asset_data.Name]
-    new_data.Type = [ASSET_DICT[item] for item in asset_data.Type]
-    guids = [item for item in asset_data.ID]
-    new_data.GUID = guids
-    babysourcedata = rela_data.loc[rela_data["Source"].isin(guids)
-                                   & rela_data["Target"].isin(guids)]
-    final_source_guid = [row.Source for index, row in babysourcedata.iterrows()]
-    final_target_guid = [row.Target for index, row in babysourcedata.iterrows()]
-    final_source_name = [re.sub(r'\([^)]*\)', '', str(asset_data.loc[asset_data['ID'] == item, 'Name'].item()))
-                         for item in final_source_guid]
-    final_target_name = [re.sub(r'\([^)]*\)', '', str(asset_data.loc[asset_data['ID'] == item, 'Name'].item()))
-                         for item in final_target_guid]
-    final_rela_type_id = [RELA_DICT[row.Type] for index, row in babysourcedata.iterrows()]
-    asset_table = get_assets()
-    asset_table_names = {row["name"]:row["display_id"] for index, row in asset_table.iterrows()}
-    for item, second_item, third in zip(final_source_name, final_target_name, final_rela_type_id):
-        headers = {'Content-Type': 'application/json'}
-        second_item = str(second_item).strip()
-        item = str(item).strip()
-        dictionary = {"type": "config_items",
-                      "type_id": [asset_table_names[second_item]],
-                      "relationship_type_id": third,
-                      "relationship_type": "forward_relationship"}
-        data2 = json.dumps(dictionary)
-        try:
-            response = requests.post(f"https://{fresh.domain}/cmdb/items/{str(asset_table_names[item])}/associate.json",
-                                     headers=headers, data=data2, auth=(fresh.api_key, fresh.password)
-                                     )
-            get_calls()
-            print(response.content)
-        except:
-            print(f"There was an error uploading a relationship with a source of {item} and a target of {second_item}.")
+    elements = pd.concat(read_export(asset_data, filetype, ["ID", "Name"], excel_columns="B:E",
+                                     table="elements"))
+    element_names = pd.Series(normalize_names(elements["Name"]).values,
+                              index=elements["ID"].astype(str))
+    element_names = element_names[~element_names.index.duplicated(keep="first")]
+    with metrics.phase("fetch snapshot"):
+        snapshot = get_snapshot()
+    index = AssetIndex(snapshot)
+    tag_ids = {tag: record["display_id"] for tag, record in index.by_tag.items()}
+    type_ids = rela_type_ids()
+    client = get_client()
+    edge_keys = ["source_id", "target_id", "rela_type_id"]
+    if incremental:
+        managed = {int(tag_ids[guid]) for guid in element_names.index if guid in tag_ids}
+        # only the CIs of this elements file can have edges to add or detach
+        with metrics.phase("fetch snapshot"):
+            relationship_data = fetch_relationships(sorted(managed))
+        existing = _current_edges(pd.DataFrame({"display_id": list(relationship_data),
+                                                "relationship_data": list(relationship_data.values())}))
+        existing = existing[existing["source_id"].isin(managed) & existing["target_id"].isin(managed)
+                            & existing["rela_type_id"].isin(type_ids.values())]
+        existing_keys = pd.MultiIndex.from_frame(existing[edge_keys])
+        seen_keys = set()
+    report = ExecutionReport()
+    rejected_count = added = unchanged = 0
+    # a reject file left by an earlier run would still look current after a clean one
+    try:
+        os.remove(reject_file)
+    except FileNotFoundError:
+        pass
+    for chunk, rela_chunk in enumerate(read_export(rela_data, filetype, RELATION_COLUMNS, chunksize,
+                                                   excel_columns="B:G", table="relations")):
+        relations = rela_chunk.loc[rela_chunk["Source"].isin(element_names.index)
+                                   & rela_chunk["Target"].isin(element_names.index)]
+        relations = relations.assign(source_name=relations["Source"].map(element_names),
+                                     target_name=relations["Target"].map(element_names),
+                                     source_id=relations["Source"].map(tag_ids),
+                                     target_id=relations["Target"].map(tag_ids),
+                                     rela_type_id=relations["Type"].map(type_ids))
+        reasons = pd.Series("", index=relations.index)
+        reasons[relations["source_id"].isna()] += "source not in CMDB;"
+        reasons[relations["target_id"].isna()] += "target not in CMDB;"
+        reasons[relations["rela_type_id"].isna()] += "unknown relationship type;"
+        rejected = relations[reasons != ""].assign(reason=reasons[reasons != ""].str.rstrip(";"))
+        if not rejected.empty:
+            rejected.to_csv(reject_file, index=False, mode="a" if rejected_count else "w",
+                            header=not rejected_count)
+            rejected_count += len(rejected)
+        resolved = relations[reasons == ""].astype({"source_id": int, "target_id": int})
+        if incremental:
+            keys = pd.MultiIndex.from_frame(resolved[edge_keys])
+            seen_keys.update(keys)
+            present = keys.isin(existing_keys)
+            unchanged += int(present.sum())
+            resolved = resolved[~present]
+        if journal is not None:
+            # edges this chunk already journaled must not be posted again in a regrouped call
+            covered = pd.MultiIndex.from_tuples(list(_associated_edges(journal.journaled("relations", chunk))),
+                                                names=edge_keys)
+            resolved = resolved[~pd.MultiIndex.from_frame(resolved[edge_keys]).isin(covered)]
+        added += len(resolved)
+        operations = []
+        for (source_id, rela_type_id), group in resolved.groupby(["source_id", "rela_type_id"], sort=False):
+            targets = [int(target_id) for target_id in group["target_id"].unique()]
+            dictionary = {"type": "config_items",
+                          "type_id": targets,
+                          "relationship_type_id": rela_type_id,
+                          "relationship_type": "forward_relationship"}
+            operations.append(Operation("POST", f"/cmdb/items/{int(source_id)}/associate.json",
+                                        json.dumps(dictionary), client.key_auth,
+                                        f"{group['source_name'].iloc[0]} -> {len(targets)} targets"))
+        with metrics.phase("relations"):
+            report.merge(_execute(operations, journal, "relations", chunk))
+    if rejected_count:
+        print(f"{rejected_count} relationships could not be resolved; see {reject_file}")
+    if incremental:
+        removed = existing[~existing_keys.isin(list(seen_keys)) & existing["relationship_id"].notna()]
+        print(f"{added} relationships added, {len(removed)} to detach, {unchanged} unchanged")
+        with metrics.phase("relations"):
+            report.merge(_execute([_delete_operation(source_id, "relationship", group["relationship_id"])
+                                   for source_id, group in removed.groupby("source_id", sort=False)],
+                                  journal, "detach"))
+    return report
+
+
+def _delete_operation(display_id, asset_type="asset", relationship_ids=None):
+    """Returns the Operation that delete_asset() sends for a non-permanent delete or detach."""
+    if asset_type == "asset":
+        ending = ".json"
+    if asset_type == "relationship":
+        ending = "/detach_relationship.json"
+    data = None
+    if relationship_ids is not None:
+        data = json.dumps({"relationship_ids": [int(item) for item in relationship_ids]})
+    return Operation("DELETE", f"/cmdb/items/{str(display_id)}{ending}", data,
+                     get_client().key_auth, str(display_id))
 
 
-def delete_asset(display_id, permanant=False, asset_type = "asset"):
+def _delete_forever_operation(display_id, label=None):
+    """Returns the Operation that permanently deletes a (trashed) asset."""
+    return Operation("PUT", f"/api/v2/assets/{str(display_id)}/delete_forever", None,
+                     get_client().key_auth, label or str(display_id))
+
+
+def delete_asset(display_id, permanant=False, asset_type = "asset", relationship_ids=None):
     """Delete a specified Asset/CI from the freshservice CMDB 
     Parameters
     ----------
     display_id : str
         Specify the display_id of the asset/CI you would like to delete from
         the CMDB.
+    asset_type: str, optional
+        "asset" deletes the CI; "relationship" detaches relationships from it. Default is "asset".
+    relationship_ids: list, optional
+        With asset_type="relationship", the ids of the relationships to detach.
     """
 #     if filetype == "csv": 
 #         csv_data = pd.read_csv(file)
@@ -353,46 +1722,70 @@ def delete_asset(display_id, permanant=False, asset_type = "asset"):
 #     types = [ASSET_DICT[item] for item in csv_data.Type]
 #     guids = [item for item in csv_data.ID]    
         
-    headers = {'Content-Type': 'application/json'}
-    if asset_type == "asset": 
-        ending = ".json"
-    if asset_type == "relationship": 
-        ending = "/detach_relationship.json"  
+    client = get_client()
     if not permanant:
-        testing = requests.delete(f"https://{fresh.domain}/cmdb/items/{str(display_id)}{ending}",
-                                  headers=headers, auth=(fresh.api_key, fresh.password)
-                                  )
-        get_calls()
+        operation = _delete_operation(display_id, asset_type, relationship_ids)
+        testing = client.delete(operation.path, data=operation.data, auth=operation.auth)
         return json.loads(testing.content)
     else:
-        requests.put(f"https://{fresh.domain}/api/v2/assets/{str(display_id)}/delete_forever",
-                               headers=headers, auth=(fresh.api_key, fresh.password)
-                               )
-        get_calls()
+        operation = _delete_forever_operation(display_id)
+        client.put(operation.path, auth=operation.auth)
         return f"Asset #{display_id} deleted permanently"
 
 
-def mass_delete(file="", filetype = ""):
+def mass_delete(file="", filetype = "", permanent=False, batch_size=500,
+                log_file="delete_results.json"):
     """Make delete calls for every asset in the specified file
 
+    The GUIDs are joined against the CMDB snapshot in one merge, and the deletes are sent
+    through execute() with its worker pool, rate limiting and retries.
+
     :param file: ingest list to parse
     :param filetype: format of the file
-    :return: None
+    :param permanent: also permanently delete the trashed assets, batch_size at a time
+    :param batch_size: number of delete_forever calls sent per batch
+    :param log_file: JSON file recording the outcome for every GUID
+    :return: ExecutionReport of the delete calls
     """
-    if filetype == "csv":
-        csv_data = pd.read_csv(file)
-    if filetype == "xlsx":
-        csv_data = pd.read_excel(file, usecols = "B:E")
-    guids = [item for item in csv_data.ID]
-    asset_table = get_assets()
-    for guid in guids:
-        try:
-            record_frame = asset_table.loc[asset_table['asset_tag'] == guid]
-            display_id = record_frame['display_id'].values[0]
-            print('Deleting asset ' + str(display_id) + '//' + guid)
-            delete_asset(display_id)
-        except IndexError:
-            print('Could not find asset ' + guid)
+    guids = pd.concat(read_export(file, filetype, ["ID"], excel_columns="B:E", table="elements"))
+    guids = guids["ID"].dropna().astype(str).drop_duplicates()
+    with metrics.phase("fetch snapshot"):
+        snapshot = _tagged_snapshot(get_snapshot())
+    targets = guids.to_frame("guid").merge(snapshot[["asset_tag", "display_id"]], how="left",
+                                           left_on="guid", right_on="asset_tag")
+    missing = targets[targets["display_id"].isna()]
+    found = targets[targets["display_id"].notna()]
+    results = {guid: {"guid": guid, "display_id": None, "status": "not_found"}
+               for guid in missing["guid"]}
+    if not missing.empty:
+        print(f"Could not find {len(missing)} assets; see {log_file}")
+    display_ids = dict(zip(found["guid"], found["display_id"]))
+    print(f"Deleting {len(display_ids)} assets")
+    with metrics.phase("delete"):
+        report = execute(_delete_operation(display_id)._replace(label=guid)
+                         for guid, display_id in display_ids.items())
+    for operation, _ in report.succeeded:
+        results[operation.label] = {"guid": operation.label,
+                                    "display_id": display_ids[operation.label], "status": "deleted"}
+    for operation, reason in report.failed:
+        results[operation.label] = {"guid": operation.label, "display_id": display_ids[operation.label],
+                                    "status": "failed", "detail": reason}
+    invalidate_snapshot([display_ids[operation.label] for operation, _ in report.succeeded])
+    if permanent:
+        deleted = [operation.label for operation, _ in report.succeeded]
+        for start in range(0, len(deleted), batch_size):
+            batch = deleted[start:start + batch_size]
+            print(f"Permanently deleting assets {start + 1}-{start + len(batch)} of {len(deleted)}")
+            with metrics.phase("delete"):
+                forever = execute(_delete_forever_operation(display_ids[guid], guid) for guid in batch)
+            for operation, _ in forever.succeeded:
+                results[operation.label]["status"] = "deleted_forever"
+            for operation, reason in forever.failed:
+                results[operation.label]["detail"] = f"delete_forever failed: {reason}"
+            report.merge(forever)
+    with open(log_file, "w") as log:
+        json.dump(list(results.values()), log, indent=1)
+    return report
 
 
 def restore_asset(display_id):
@@ -403,15 +1796,12 @@ def restore_asset(display_id):
         Specify the display_id of the asset/CI you would like to restore in
         the CMDB.
     """
-    headers = {'Content-Type': 'application/json'}
-    restore = requests.put(f"https://{fresh.domain}/cmdb/items/{str(display_id)}/restore.json",
-                           headers=headers, auth=(fresh.api_key, fresh.password)
-                           )
-    get_calls()
+    client = get_client()
+    restore = client.put(f"/cmdb/items/{str(display_id)}/restore.json", auth=client.key_auth)
     return json.loads(restore.content)
 
 
-def filter_assets(query=""):
+def filter_assets(query="", workers=1):
     """Similar to the function of search_assets() but provides more search fields.
     Parameters
     ---------
@@ -420,21 +1810,10 @@ def filter_assets(query=""):
         user_id, agent_id, name, asset_tag, created_at, or updated_at) and a query. Queries must be surrounded by
         quotes ("%27 can be used"). Dates are in UTD formatting. An example is "created_at:%272019-05-30%27",
         which returns all assets created on May 30th, 2019.
+    workers: int, optional
+        Number of pages fetched concurrently. Default is 1 (one page at a time).
     """
-    asset_table = pd.DataFrame()
-    page_num = 1
-    pages_left = True
-    while pages_left:
-        name = requests.get(f'https://{fresh.domain}/api/v2/assets?include=type_fields&query="{query}"&page={page_num}',
-                            auth=(fresh.user, fresh.password)
-                            )
-        content = json.loads(name.content)
-        page_num += 1
-        asset_data = pd.DataFrame(content["assets"])
-        asset_table = asset_table.append(asset_data, ignore_index=True)
-        if not content["assets"]:
-            pages_left = False
-    return asset_table
+    return _records_frame(iter_filtered_assets(query, workers))
 
 
 def search_assets(field_param, query_param):
@@ -448,45 +1827,89 @@ def search_assets(field_param, query_param):
         What you would like to search for based off of the field_param. For example,
         field_param="name", query_param="andrea".
     """
-    headers = {'Content-Type': 'application/json'}
-    search = requests.get(f"https://{fresh.domain}/cmdb/items/list.json?field={field_param}&q={query_param}",
-                          headers=headers,auth=(fresh.api_key, "1234")
-                          )
-    get_calls()
+    client = get_client()
+    search = client.get(f"/cmdb/items/list.json?field={field_param}&q={query_param}",
+                        auth=client.key_auth)
     return json.loads(search.content)
 
 
-def add_dns(dns_csv="Archi_Exports/dns_csv.csv"):
+DNS_FIELD = "dns_names_10001075125"
+PROVISIONING_FIELD = "connected_to_provisioning_10001075125"
+
+
+def _level_field(record, field):
+    """Returns a type-specific field of a snapshot record, wherever the API nested it, or None."""
+    if isinstance(record.get(field), str):
+        return record[field]
+    for container in ("levelfield_values", "level_field_attributes", "type_fields"):
+        values = record.get(container)
+        if isinstance(values, dict) and values.get(field) is not None:
+            return values[field]
+    return None
+
+
+def _dns_set(names):
+    """Returns the DNS names of a comma separated list as a set, ignoring spacing and order."""
+    if not isinstance(names, str):
+        return set()
+    return {name.strip().lower() for name in names.split(",") if name.strip()}
+
+
+def add_dns(dns_csv="Archi_Exports/dns_csv.csv", workers=None):
     """Add information to the "dns_names" field of an asset
-    
+
+    Node names are resolved against the cached CMDB snapshot instead of one search call
+    per node, nodes whose DNS names already match are skipped, and the remaining updates
+    are sent through execute(). Returns the ExecutionReport.
+
     Parameters
     ----------
     dns_csv: str
         Specifies which file contains your nodes and dns names. Format inside CSV must be
         "node_name", "dns1, dns2, dns3, etc."
-    
+    workers: int, optional
+        Number of requests in flight at once. Default is WRITE_WORKERS.
     """
-    imported = pd.read_csv(dns_csv, names=("Name", "DNS"), quotechar='"', skipinitialspace=True)
-    headers = {'Content-Type': 'application/json'}
-    for index, row in imported.iterrows():
-        node_name = re.sub(r'\([^)]*\)', '', row["Name"]).strip()
-        name_match = search_assets("name", node_name)
+    imported = pd.read_csv(dns_csv, names=("Name", "DNS"), quotechar='"', skipinitialspace=True,
+                           dtype=str)
+    imported = imported.dropna(subset=["Name"])
+    imported["Name"] = normalize_names(imported["Name"])
+    imported["DNS"] = imported["DNS"].fillna("")
+    imported = imported.drop_duplicates(subset="Name", keep="last")
+    index = AssetIndex(get_snapshot())
+    operations = []
+    unknown = []
+    unchanged = 0
+    for node_name, dns in zip(imported["Name"], imported["DNS"]):
+        matches = index.name(node_name)
+        if not matches:
+            unknown.append(node_name)
+            continue
+        item = matches[0]
+        if (_dns_set(_level_field(item, DNS_FIELD)) == _dns_set(dns)
+                and _level_field(item, PROVISIONING_FIELD) == "Yes"):
+            unchanged += 1
+            continue
         dump = {'cmdb_config_item':
-                 {'name': name_match["config_items"][0]["name"],
-                  'ci_type_id': name_match["config_items"][0]['ci_type_id'],
-                  'description': name_match["config_items"][0]['description'],
-                  'asset_tag': name_match["config_items"][0]['asset_tag'],
+                 {'name': item["name"],
+                  'ci_type_id': item['ci_type_id'],
+                  'description': item.get('description') if isinstance(item.get('description'), str) else "",
+                  'asset_tag': item.get('asset_tag'),
                   'level_field_attributes':
-                      {'connected_to_provisioning_10001075125': 'Yes',
-                       "dns_names_10001075125": str(row["DNS"])
+                      {PROVISIONING_FIELD: 'Yes',
+                       DNS_FIELD: dns
                       }
                  }
                }
-        data = json.dumps(dump)
-        response = requests.put(f"https://{fresh.domain}/cmdb/items/{name_match['config_items'][0]['display_id']}.json",
-                                headers=headers, data=data, auth=(fresh.user, fresh.password)
-                                )
-        print(response.content)
+        operations.append(Operation("PUT", f"/cmdb/items/{item['display_id']}.json",
+                                    json.dumps(dump), label=node_name))
+    if unknown:
+        print(f"No CMDB item named: {', '.join(unknown)}")
+    print(f"Updating DNS names of {len(operations)} nodes, {unchanged} already up to date")
+    report = execute(operations, workers)
+    if report.succeeded:
+        invalidate_snapshot()
+    return report
 
 
 def clone_artifacts(csv="Archi_Exports/VladArtifacts.csv", era="Archi_Exports/LSST_eras.csv"):
@@ -500,73 +1923,12 @@ def clone_artifacts(csv="Archi_Exports/VladArtifacts.csv", era="Archi_Exports/LS
     era: str, optional
         Specifies which era parameters file to pull from. Default value is "Archi_Exports/LSST_eras.csv"
     """
-    csv_data = pd.read_csv(csv)
-    upload_data = pd.DataFrame(columns=["Name", "Type", "GUID", "Documentation"])
+    csv_data = pd.read_csv(csv, usecols=ELEMENT_COLUMNS, dtype=str)
     era_data = pd.read_csv(era)
-    # cnx = sqlite3.connect('/Users/audreykoziol/Desktop/freshservice/Untitled.sqlite')
-    # csv_data = pd.read_sql_query("SELECT * FROM elements", cnx)
-    # print(csv_data['class'])
-    names = ["*FUTURE* "+item for item in csv_data.Name]
-    types = [ASSET_DICT[item] for item in csv_data.Type]
-    guids = ["f_"+item for item in csv_data.ID]
-    documentation = [item for item in csv_data.Documentation]
-    upload_data.Name = names
-    upload_data['Name'].str.replace(r"\(.*\)", "")
-    upload_data.Type = types
-    upload_data.GUID = guids
-    upload_data.Documentation = documentation
-    current_assets = get_assets()
-    if current_assets.empty == False:
-        # for index, row in current_assets.iterrows():
-            # if row["asset_tag"] in list(upload_data['GUID']):
-                # pass
-            # else:
-                # delete_asset(row["display_id"])
-        for index, row in upload_data.iterrows():
-            dump = {'cmdb_config_item':
-                     {'name': re.sub(r'\([^)]*\)', '', str(row.Name)),
-                      'ci_type_id': str(row.Type),
-                      'description': str(row.Documentation),
-                      'asset_tag': str(row.GUID),
-                      'level_field_attribute':
-                          {f'bytes_{row.Type}': str(era_data.loc[0]["Fires"]),
-                           f'era_2_storage_{row.Type}': str(era_data.loc[1]["Fires"])
-                          }
-                     }
-                   }
-            data = json.dumps(dump)
-            print(data)
-            headers = {'Content-Type': 'application/json'}
-            if current_assets['asset_tag'].str.contains(row["GUID"]).any():
-                if str(row["Documentation"]).strip() == current_assets[current_assets['asset_tag'].str.match(row["GUID"])]['description'].values[0] and row["Type"] == current_assets[current_assets['asset_tag'].str.match(row["GUID"])]['ci_type_id'].values[0] and re.sub(r'\([^)]*\)', '', str(row.Name)).strip() == current_assets[current_assets['asset_tag'].str.match(row["GUID"])]['name'].values[0]:
-                    pass
-                else:
-                    item_id = current_assets[current_assets['asset_tag'].str.match(row["GUID"])]['display_id'].values[0]
-                    response = requests.put(f"https://{fresh.domain}/cmdb/items/{item_id}.json",
-                                            headers=headers, data=data, auth=(fresh.user, fresh.password)
-                                            )
-                    print(response.content)
-            else:
-                response = requests.post(f"https://{fresh.domain}/cmdb/items.json",
-                                         headers=headers, data=data, auth=(fresh.user, fresh.password)
-                                         )
-                print(response.content)
-    else:
-        for index, row in upload_data.iterrows():
-            dump = {'cmdb_config_item':
-                     {'name': re.sub(r'\([^)]*\)', '', str(row.Name)),
-                      'ci_type_id': str(row.Type),
-                      'description':str(row.Documentation),
-                      'asset_tag':str(row.GUID),
-                      'level_field_attributes':
-                          {f'bytes_{row.Type}': str(era_data.loc[0]["Fires"]),
-                           f'era_2_storage_{row.Type}': str(era_data.loc[1]["Fires"])
-                          }
-                     }
-                   }
-            data = json.dumps(dump)
-            headers = {'Content-Type': 'application/json'}
-            response = requests.post(f"https://{fresh.domain}/cmdb/items.json", headers=headers,
-                                     data=data, auth=(fresh.user, fresh.password)
-                                     )
-            print(response.content)
+    upload_data = _upload_frame(csv_data.assign(Name="*FUTURE* " + csv_data["Name"],
+                                                ID="f_" + csv_data["ID"]), asset_type_ids())
+    plan = plan_changes(upload_data, get_snapshot())
+    apply_plan(plan, lambda ci_type: {f'bytes_{ci_type}': str(era_data.loc[0]["Fires"]),
+                                      f'era_2_storage_{ci_type}': str(era_data.loc[1]["Fires"])},
+               verbose=True)
+    invalidate_snapshot()
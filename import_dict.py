@@ -1,18 +1,18 @@
 import csv2cmdb as csv2
-import difflib
 import pandas as pd
 
 data = input("Relationship file:")
 rela_data = pd.read_csv(data)
+matcher = csv2.TypeMatcher(rela_data["Type"].unique())
 rela_dict = {}
-for item in range(len(csv2.get_rela_types())):
-    number = csv2.get_rela_types()[item]["id"]
-    name = csv2.get_rela_types()[item]["forward_relationship"]
+for rela_type in csv2.get_rela_types():
+    number = rela_type["id"]
+    name = rela_type["forward_relationship"]
     print(name.replace(" ", ""))
-    match = difflib.get_close_matches(name.replace(" ", "")+"Relationship",rela_data["Type"].unique(), n = 1)
+    match = matcher.match(name)
     print(match)
-    if match == []:
+    if match is None:
         pass
     else:
-        rela_dict[match[0]]  =  number
-print(rela_dict)
\ No newline at end of file
+        rela_dict[match]  =  number
+print(rela_dict)
@@ -1,21 +1,70 @@
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 import csv2cmdb as c
 import re
-import box
+import metrics
 
 
 def ingest(args):
     """Upload the elements and connections to Freshservice"""
-    c.add_update_assets(args.elemfile, filetype(args.elemfile))
-    c.add_rela(args.relfile, args.elemfile, filetype(args.elemfile))
-    # upload the files to the archive
-    box.box_upload_elements(args.elemfile)
-    box.box_upload_relations(args.relfile)
+    elemfile, relfile, ftype = sources(args)
+    if args.dry_run:
+        c.add_update_assets(elemfile, ftype, dry_run=True, chunksize=args.chunksize)
+        return
+    try:
+        journal = c.IngestJournal(args.journal, args.resume, sources=sorted({elemfile, relfile}),
+                                  elemfile=elemfile, relfile=relfile, filetype=ftype,
+                                  chunksize=args.chunksize, incremental=args.incremental)
+    except ValueError as ex:
+        print(f"Cannot resume: {ex}")
+        return
+    if args.resume and journal.finished:
+        print(f"The run recorded in {args.journal} already finished")
+        return
+    uploads = []
+    if not args.db:
+        # archive the exported files while the CMDB sync runs; with --db there are none.
+        # box (boxsdk, pyjwt, cryptography) is only imported when there is something to upload
+        import box
+        archiver = ThreadPoolExecutor(max_workers=2)
+        uploads = [archiver.submit(archive, box.box_upload_elements, args.elemfile),
+                   archiver.submit(archive, box.box_upload_relations, args.relfile)]
+        archiver.shutdown(wait=False)
+    c.add_update_assets(elemfile, ftype, chunksize=args.chunksize, journal=journal)
+    c.add_rela(relfile, elemfile, ftype, incremental=args.incremental, chunksize=args.chunksize,
+               journal=journal)
+    left = journal.finish()
+    journal.close()
+    if left:
+        print(f"{left} writes did not complete; rerun with --resume to retry only those")
+    for upload in uploads:
+        try:
+            upload.result()
+        except Exception as ex:
+            print(f"Archive upload failed: {ex!r}")
+
+
+def archive(upload, file):
+    """Upload one exported file to its Box archive folder, timed as the "archive upload" phase"""
+    with metrics.phase("archive upload"):
+        upload(file)
 
 
 def delete(args):
     """Delete the elements and connections from Freshservice"""
-    c.mass_delete(args.elemfile,filetype(args.elemfile))
+    elemfile, _, ftype = sources(args)
+    c.mass_delete(elemfile, ftype, permanent=args.permanent, log_file=args.log)
+
+
+def sources(args):
+    """Return the elements source, relationships source and their filetype
+
+    :param args: parsed command line arguments
+    :return: tuple
+    """
+    if args.db:
+        return args.db, args.db, "db"
+    return args.elemfile, args.relfile, filetype(args.elemfile)
 
 
 def filetype(str):
@@ -34,15 +83,48 @@ if __name__ == "__main__":
         formatter_class=argparse.RawDescriptionHelpFormatter)
     main_parser.add_argument("--elemfile", "-e", default=None, help='element file')
     main_parser.add_argument("--relfile", "-r", default=None, help='relationships file')
+    main_parser.add_argument("--db", default=None,
+                             help='Archi SQLite database to read elements and relationships from')
+    main_parser.add_argument("--pool-size", type=int, default=20,
+                             help='maximum kept-alive connections to Freshservice')
+    main_parser.add_argument("--workers", type=int, default=c.WRITE_WORKERS,
+                             help='concurrent write requests to Freshservice')
+    main_parser.add_argument("--read-workers", type=int, default=4,
+                             help='CMDB pages downloaded concurrently')
+    main_parser.add_argument("--rate-limit", type=int, default=c.RATE_LIMIT_PER_MINUTE,
+                             help="the Freshservice account's API requests per minute")
+    main_parser.add_argument("--no-cache", action="store_true",
+                             help='always download the CMDB instead of using the local snapshot cache')
+    main_parser.add_argument("--profile", nargs="?", const="csv2cmdb_metrics.json", default=None,
+                             metavar="FILE",
+                             help='print request and phase timings and write them as JSON to FILE '
+                                  '(default csv2cmdb_metrics.json)')
+    main_parser.add_argument("--refresh", choices=["incremental", "full"], default=None,
+                             help='refresh the cached CMDB snapshot before using it')
 
     subparsers = main_parser.add_subparsers(title="subcommands",
                                             description='valid subcommands',
                                             help='additional help')
 
     ingest_parser = subparsers.add_parser('ingest', description=ingest.__doc__)
+    ingest_parser.add_argument("--dry-run", action="store_true",
+                               help='print the planned CMDB changes without sending them')
+    ingest_parser.add_argument("--incremental", action="store_true",
+                               help='only add new relationships and detach removed ones')
+    ingest_parser.add_argument("--chunksize", type=int, default=None,
+                               help='read, diff and upload the exports this many rows at a time')
+    ingest_parser.add_argument("--journal", default="ingest_journal.sqlite",
+                               help='SQLite file recording every planned and completed write')
+    ingest_parser.add_argument("--resume", action="store_true",
+                               help='continue the interrupted run recorded in the journal, '
+                                    'sending only the writes it has not completed')
     ingest_parser.set_defaults(func=ingest)
 
     delete_parser = subparsers.add_parser('delete', description=delete.__doc__)
+    delete_parser.add_argument("--permanent", action="store_true",
+                               help='also delete the trashed assets permanently')
+    delete_parser.add_argument("--log", default="delete_results.json",
+                               help='JSON file recording the outcome for every asset')
     delete_parser.set_defaults(func=delete)
 
     args = main_parser.parse_args()
@@ -53,12 +135,28 @@ if __name__ == "__main__":
         main_parser.print_help()
         exit(1)
 
-    # fix timestamp
-    args.elemfile = args.elemfile.replace('\\', '')
-    args.relfile = args.relfile.replace('\\', '')
-
-    if not args.elemfile or not args.relfile:
-        print('Please provide both the elements and relationships file')
+    if not args.db and (not args.elemfile or not args.relfile):
+        print('Please provide both the elements and relationships file, or --db')
         exit(1)
 
-    args.func(args)
\ No newline at end of file
+    # fix timestamp
+    if not args.db:
+        args.elemfile = args.elemfile.replace('\\', '')
+        args.relfile = args.relfile.replace('\\', '')
+
+    c.configure_client(pool_maxsize=max(args.pool_size, args.workers, args.read_workers))
+    c.configure_rate_limit(args.rate_limit)
+    c.WRITE_WORKERS = args.workers
+    c.READ_WORKERS = args.read_workers
+    if args.no_cache:
+        c.configure_snapshot_cache(enabled=False)
+    elif args.refresh:
+        with metrics.phase("fetch snapshot"):
+            c.get_snapshot(refresh=args.refresh)
+    try:
+        args.func(args)
+    finally:
+        if args.profile:
+            print(metrics.get_metrics().summary())
+            metrics.get_metrics().export(args.profile)
+            print(f"Metrics written to {args.profile}")
\ No newline at end of file
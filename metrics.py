@@ -0,0 +1,164 @@
+"""
+Thread-safe request metrics and phase timers for the Freshservice and Box calls made by
+csv2cmdb, box and main.py.
+"""
+
+import re
+import json
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+
+# upper bounds, in milliseconds, of the latency histogram buckets; the last one is open
+LATENCY_BUCKETS = [10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+ID_SEGMENT = re.compile(r'/\d+(?=/|\.json|$)')
+
+
+def endpoint(path):
+    """Returns the endpoint a request path belongs to: query string dropped and numeric ids
+    replaced by {id}, so /cmdb/items/42.json and /cmdb/items/43.json are counted together.
+    """
+    return ID_SEGMENT.sub('/{id}', path.split("?", 1)[0])
+
+
+class Metrics:
+    """Per-endpoint call counts, status codes, latency histograms, bytes transferred and
+    retries, plus cumulative phase timers. Every method may be called from any thread.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.endpoints = {}
+            self.phases = {}
+            self.started = time.time()
+
+    def _endpoint(self, service, method, path):
+        key = f"{service} {method} {endpoint(path)}"
+        if key not in self.endpoints:
+            self.endpoints[key] = {"calls": 0, "errors": 0, "retries": 0, "status": {},
+                                   "seconds": 0.0, "max_seconds": 0.0,
+                                   "bytes_sent": 0, "bytes_received": 0,
+                                   "latency_ms": [0] * (len(LATENCY_BUCKETS) + 1)}
+        return self.endpoints[key]
+
+    def record_call(self, service, method, path, seconds, status=None, bytes_sent=0,
+                    bytes_received=0):
+        """Record one HTTP request. status is None if no response was received.
+        Parameters
+        ----------
+        service: str
+            "freshservice" or "box".
+        method, path: str
+            HTTP method and the URL path that was requested.
+        seconds: float
+            Time until the response (or the connection error) arrived.
+        status: int, optional
+            HTTP status code of the response.
+        bytes_sent, bytes_received: int, optional
+            Request and response body sizes.
+        """
+        with self.lock:
+            stats = self._endpoint(service, method, path)
+            stats["calls"] += 1
+            if status is None or status >= 400:
+                stats["errors"] += 1
+            status = str(status or "error")
+            stats["status"][status] = stats["status"].get(status, 0) + 1
+            stats["seconds"] += seconds
+            stats["max_seconds"] = max(stats["max_seconds"], seconds)
+            stats["bytes_sent"] += bytes_sent
+            stats["bytes_received"] += bytes_received
+            stats["latency_ms"][bisect.bisect_left(LATENCY_BUCKETS, seconds * 1000)] += 1
+
+    def record_retry(self, service, method, path):
+        """Record that a request is about to be sent again."""
+        with self.lock:
+            self._endpoint(service, method, path)["retries"] += 1
+
+    @contextmanager
+    def phase(self, name):
+        """Context manager adding the time spent inside it to the named phase. Phases may
+        nest and may be entered repeatedly, e.g. once per chunk."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                timer = self.phases.setdefault(name, {"count": 0, "seconds": 0.0})
+                timer["count"] += 1
+                timer["seconds"] += elapsed
+
+    def total_calls(self, service=None):
+        """Returns the number of requests recorded, for one service or for all of them."""
+        with self.lock:
+            return sum(stats["calls"] for key, stats in self.endpoints.items()
+                       if service is None or key.split(" ", 1)[0] == service)
+
+    def as_dict(self):
+        """Returns a JSON-serializable copy of everything recorded so far."""
+        with self.lock:
+            endpoints = {}
+            for key, stats in sorted(self.endpoints.items()):
+                stats = dict(stats, status=dict(stats["status"]))
+                stats["mean_seconds"] = stats["seconds"] / stats["calls"] if stats["calls"] else 0.0
+                stats["latency_ms"] = dict(zip([f"<={bound}" for bound in LATENCY_BUCKETS]
+                                               + [f">{LATENCY_BUCKETS[-1]}"], stats["latency_ms"]))
+                endpoints[key] = stats
+            return {"started": self.started,
+                    "elapsed_seconds": time.time() - self.started,
+                    "phases": {name: dict(timer) for name, timer in self.phases.items()},
+                    "endpoints": endpoints}
+
+    def export(self, path):
+        """Write as_dict() to a JSON file."""
+        with open(path, "w") as out:
+            json.dump(self.as_dict(), out, indent=1)
+
+    def summary(self):
+        """Returns a printable table of the phases and the busiest endpoints."""
+        report = self.as_dict()
+        lines = [f"{'phase':<40}{'count':>8}{'seconds':>12}"]
+        lines += [f"{name:<40}{timer['count']:>8}{timer['seconds']:>12.3f}"
+                  for name, timer in report["phases"].items()]
+        lines.append(f"{'endpoint':<52}{'calls':>7}{'retries':>8}{'errors':>7}{'mean ms':>9}{'MiB':>8}")
+        for key, stats in sorted(report["endpoints"].items(), key=lambda item: -item[1]["calls"]):
+            megabytes = (stats["bytes_sent"] + stats["bytes_received"]) / 2 ** 20
+            lines.append(f"{key:<52}{stats['calls']:>7}{stats['retries']:>8}{stats['errors']:>7}"
+                         f"{stats['mean_seconds'] * 1000:>9.1f}{megabytes:>8.2f}")
+        return "\n".join(lines)
+
+
+# the registry shared by csv2cmdb, box and main.py
+_metrics = Metrics()
+
+
+def get_metrics():
+    """Returns the shared Metrics registry."""
+    return _metrics
+
+
+def record_call(*args, **kwargs):
+    _metrics.record_call(*args, **kwargs)
+
+
+def record_retry(*args, **kwargs):
+    _metrics.record_retry(*args, **kwargs)
+
+
+def phase(name):
+    return _metrics.phase(name)
+
+
+def body_size(data):
+    """Returns the size of a request body in bytes; streamed bodies (files) count as 0."""
+    if isinstance(data, str):
+        return len(data.encode())
+    if isinstance(data, (bytes, bytearray)):
+        return len(data)
+    return 0
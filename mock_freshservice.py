@@ -0,0 +1,310 @@
+"""
+A local stand-in for the Freshservice API, used to benchmark csv2cmdb without touching
+the live tenant. It keeps an in-memory CMDB and implements the endpoints csv2cmdb uses:
+
+    GET    /cmdb/items.json                           paginated items
+    POST   /cmdb/items.json                           create an item
+    PUT    /cmdb/items/{id}.json                      update an item
+    DELETE /cmdb/items/{id}.json                      move an item to the trash
+    PUT    /cmdb/items/{id}/restore.json              restore a trashed item
+    POST   /cmdb/items/{id}/associate.json            add relationships
+    GET    /cmdb/items/{id}/relationships.json        an item's relationships
+    DELETE /cmdb/items/{id}/detach_relationship.json  remove relationships
+    GET    /cmdb/relationship_types/list.json         relationship types
+    GET    /cmdb/ci_types.json                        CI types
+    GET    /api/v2/assets                             paginated items, filtered by updated_at
+    PUT    /api/v2/assets/{id}/delete_forever         permanently delete a trashed item
+"""
+
+import re
+import json
+import time
+import datetime as dt
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs, unquote
+
+ITEM_PATH = re.compile(r'^/cmdb/items/(\d+)(\.json|/restore\.json|/associate\.json|'
+                       r'/relationships\.json|/detach_relationship\.json)$')
+DELETE_FOREVER_PATH = re.compile(r'^/api/v2/assets/(\d+)/delete_forever$')
+UPDATED_SINCE = re.compile(r"updated_at:>'(\d{4}-\d{2}-\d{2})")
+
+
+def make_items(count, start=1):
+    """Returns a list of synthetic CMDB items shaped like /cmdb/items.json records.
+    Parameters
+    ----------
+    count: int
+        Number of items to generate.
+    start: int, optional
+        display_id of the first item. Default is 1.
+    """
+    return [{"display_id": display_id,
+             "name": f"CI {display_id}",
+             "ci_type_id": 10001075119,
+             "description": f"Synthetic item {display_id}",
+             "asset_tag": f"id-{display_id:08x}",
+             "updated_at": "2019-06-01T00:00:00-04:00"}
+            for display_id in range(start, start + count)]
+
+
+def _now():
+    return dt.datetime.now(dt.timezone.utc).isoformat(timespec="seconds")
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, payload, status=200, headers=None):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        if not length:
+            return {}
+        try:
+            return json.loads(self.rfile.read(length))
+        except ValueError:
+            return {}
+
+    def _admit(self):
+        """Apply the configured latency and rate limit. Returns the rate limit headers, or
+        None after answering 429."""
+        server = self.server
+        time.sleep(server.latency)
+        if not server.rate_limit:
+            return {}
+        with server.lock:
+            now = time.monotonic()
+            if now - server.window_start >= server.rate_window:
+                server.window_start, server.window_used = now, 0
+            retry_after = max(1, int(server.window_start + server.rate_window - now + 0.999))
+            if server.window_used >= server.rate_limit:
+                server.throttled += 1
+                limited = True
+            else:
+                server.window_used += 1
+                limited = False
+            remaining = server.rate_limit - server.window_used
+        headers = {"X-RateLimit-Total": str(server.rate_limit),
+                   "X-RateLimit-Remaining": str(remaining)}
+        if limited or not remaining:
+            headers["Retry-After"] = str(retry_after)
+        if limited:
+            self._send({"message": "You have exceeded the limit of requests per minute"}, 429, headers)
+            return None
+        return headers
+
+    def _dispatch(self, method):
+        headers = self._admit()
+        if headers is None:
+            return
+        body = self._body() if method in ("POST", "PUT", "DELETE") else {}
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        with self.server.lock:
+            self.server.requests[method] = self.server.requests.get(method, 0) + 1
+        try:
+            payload, status = self.server.cmdb.handle(method, url.path, query, body)
+        except KeyError:
+            payload, status = {"errors": "not found"}, 404
+        self._send(payload, status, headers)
+
+    def do_GET(self):
+        self._dispatch("GET")
+
+    def do_POST(self):
+        self._dispatch("POST")
+
+    def do_PUT(self):
+        self._dispatch("PUT")
+
+    def do_DELETE(self):
+        self._dispatch("DELETE")
+
+
+class _CMDB:
+    """The in-memory CMDB behind MockFreshservice. handle() returns (payload, status) and
+    raises KeyError for unknown paths and items."""
+
+    def __init__(self, items, per_page, ci_types, relationship_types):
+        self.lock = threading.Lock()
+        self.items = {int(item["display_id"]): dict(item) for item in items}
+        self.trash = {}
+        self.relationships = {}
+        self.next_display_id = max(self.items, default=0) + 1
+        self.next_relationship_id = 1
+        self.per_page = per_page
+        self.ci_types = list(ci_types or [])
+        self.relationship_types = list(relationship_types or [])
+        self.listing = None
+        self.filtered = None
+
+    def _page(self, query):
+        page = int(query.get("page", ["1"])[0])
+        if self.listing is None:
+            self.listing = list(self.items.values())
+        return self.listing[(page - 1) * self.per_page:page * self.per_page]
+
+    def handle(self, method, path, query, body):
+        with self.lock:
+            if path == "/cmdb/items.json":
+                if method == "GET":
+                    return self._page(query), 200
+                if method == "POST":
+                    return self._create(body.get("cmdb_config_item", {})), 200
+            if path == "/api/v2/assets" and method == "GET":
+                return {"assets": self._filtered_page(query)}, 200
+            if path == "/cmdb/relationship_types/list.json" and method == "GET":
+                return self.relationship_types, 200
+            if path == "/cmdb/ci_types.json" and method == "GET":
+                return self.ci_types, 200
+            match = DELETE_FOREVER_PATH.match(path)
+            if match and method == "PUT":
+                del self.trash[int(match.group(1))]
+                return {}, 200
+            match = ITEM_PATH.match(path)
+            if match:
+                return self._item(method, int(match.group(1)), match.group(2), body)
+        raise KeyError(path)
+
+    def _create(self, fields):
+        display_id = self.next_display_id
+        self.next_display_id += 1
+        self.items[display_id] = dict(fields, display_id=display_id, updated_at=_now())
+        self.listing = self.filtered = None
+        return {"item": {"config_item": self.items[display_id]}}
+
+    def _filtered_page(self, query):
+        since = UPDATED_SINCE.search(unquote(query.get("query", [""])[0]).replace("%27", "'"))
+        since = since.group(1) if since else ""
+        page = int(query.get("page", ["1"])[0])
+        if self.filtered is None or self.filtered[0] != since:
+            self.filtered = (since, [item for item in self.items.values()
+                                     if item.get("updated_at", "")[:10] >= since])
+        assets = []
+        for item in self.filtered[1][(page - 1) * self.per_page:page * self.per_page]:
+            asset = {key: value for key, value in item.items() if key != "ci_type_id"}
+            asset["asset_type_id"] = item.get("ci_type_id")
+            assets.append(asset)
+        return assets
+
+    def _item(self, method, display_id, ending, body):
+        if ending == "/restore.json" and method == "PUT":
+            self.items[display_id] = self.trash.pop(display_id)
+            self.listing = self.filtered = None
+            return {"status": True}, 200
+        item = self.items[display_id]
+        if ending == ".json":
+            if method == "PUT":
+                item.update(body.get("cmdb_config_item", {}), updated_at=_now())
+                self.filtered = None
+                return {"item": {"config_item": item}}, 200
+            if method == "DELETE":
+                self.trash[display_id] = self.items.pop(display_id)
+                self.relationships.pop(display_id, None)
+                self.listing = self.filtered = None
+                return {"status": True}, 200
+        if ending == "/associate.json" and method == "POST":
+            relationships = self.relationships.setdefault(display_id, [])
+            for target in body.get("type_id", []):
+                relationships.append({"id": self.next_relationship_id,
+                                      "relationship_type": body.get("relationship_type",
+                                                                    "forward_relationship"),
+                                      "relationship_type_id": body.get("relationship_type_id"),
+                                      "config_item": {"display_id": int(target)}})
+                self.next_relationship_id += 1
+            return {"status": True}, 200
+        if ending == "/relationships.json" and method == "GET":
+            return {"relationships": self.relationships.get(display_id, [])}, 200
+        if ending == "/detach_relationship.json" and method == "DELETE":
+            detached = {int(relationship_id) for relationship_id in body.get("relationship_ids", [])}
+            self.relationships[display_id] = [relationship for relationship in
+                                              self.relationships.get(display_id, [])
+                                              if relationship["id"] not in detached]
+            return {"status": True}, 200
+        raise KeyError(ending)
+
+
+class MockFreshservice:
+    """Threaded HTTP server holding an in-memory CMDB on localhost.
+    Parameters
+    ----------
+    items: list, optional
+        CMDB item records to start with. Default is no items.
+    latency: float, optional
+        Seconds to wait before answering each request. Default is 0.
+    per_page: int, optional
+        Page size for paginated endpoints. Default is 30, matching Freshservice.
+    rate_limit: int, optional
+        Requests answered per rate_window seconds before answering 429 with Retry-After.
+        Default is None (unlimited).
+    rate_window: float, optional
+        Length of the rate limit window in seconds. Default is 60.
+    ci_types: list, optional
+        Records served by /cmdb/ci_types.json. Default is none.
+    relationship_types: list, optional
+        Records served by /cmdb/relationship_types/list.json. Default is none.
+    """
+
+    def __init__(self, items=None, latency=0.0, per_page=30, rate_limit=None, rate_window=60.0,
+                 ci_types=None, relationship_types=None):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        self.server.daemon_threads = True
+        self.server.cmdb = _CMDB(items or [], per_page, ci_types, relationship_types)
+        self.server.latency = latency
+        self.server.rate_limit = rate_limit
+        self.server.rate_window = rate_window
+        self.server.window_start = time.monotonic()
+        self.server.window_used = 0
+        self.server.throttled = 0
+        self.server.requests = {}
+        self.server.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.server.server_address
+        return f"http://{host}:{port}"
+
+    @property
+    def cmdb(self):
+        """The in-memory CMDB: .items and .trash map display_id to item, .relationships maps
+        a source display_id to its relationship records."""
+        return self.server.cmdb
+
+    @property
+    def requests(self):
+        """Number of requests answered (429s excluded), by HTTP method."""
+        return dict(self.server.requests)
+
+    @property
+    def throttled(self):
+        """Number of requests answered with 429."""
+        return self.server.throttled
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
@@ -0,0 +1,51 @@
+"""
+Reading an Archi SQLite database with read_archi_db().
+
+    python -m pytest test_archi_db.py
+"""
+
+import os
+import sys
+import types
+import sqlite3
+import tempfile
+import unittest
+from contextlib import closing
+
+try:
+    import freshlogin
+except ImportError:
+    # nothing is sent, so no real credentials are needed
+    sys.modules["freshlogin"] = types.SimpleNamespace(domain="localhost", user="user",
+                                                      password="password", api_key="key")
+
+import csv2cmdb as c
+
+
+class ReadArchiDb(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.database = os.path.join(self.folder.name, "archi.db")
+        with closing(sqlite3.connect(self.database)) as conn, conn:
+            conn.execute('CREATE TABLE elements ("ID" TEXT, "Type" TEXT, "Name" TEXT, "Documentation" TEXT)')
+            conn.executemany("INSERT INTO elements VALUES (?, ?, ?, ?)",
+                             [("id-1", "Node", "Server", None),
+                              ("id-2", "Node", "Switch", "Core switch"),
+                              ("id-3", "Grouping", "Group", None)])
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_null_is_read_as_an_empty_string(self):
+        elements = next(c.read_archi_db(self.database, "elements", c.ELEMENT_COLUMNS))
+        self.assertEqual(list(elements["Documentation"]), ["", "Core switch", ""])
+
+    def test_types_filter_and_chunks(self):
+        chunks = list(c.read_archi_db(self.database, "elements", c.ELEMENT_COLUMNS, chunksize=1,
+                                      types=["Node"]))
+        self.assertEqual([list(chunk["ID"]) for chunk in chunks], [["id-1"], ["id-2"]])
+
+
+if __name__ == "__main__":
+    unittest.main()
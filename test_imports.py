@@ -0,0 +1,55 @@
+"""
+Importing main.py or csv2cmdb must not load pandas, numpy, requests or boxsdk; see
+HEAVY_MODULES in benchmark.py.
+
+    python -m pytest test_imports.py
+"""
+
+import os
+import sys
+import types
+import tempfile
+import unittest
+from importlib.machinery import PathFinder
+
+FRESHLOGIN_STANDIN = 'domain = "localhost"\nuser = "user"\npassword = "password"\napi_key = "key"\n'
+
+# the fresh interpreters need a freshlogin.py on disk, whatever other tests put in sys.modules
+STANDIN = None if PathFinder.find_spec("freshlogin") else FRESHLOGIN_STANDIN
+if "freshlogin" not in sys.modules and STANDIN:
+    # only the imports are measured, so placeholder credentials are enough
+    sys.modules["freshlogin"] = types.SimpleNamespace(domain="localhost", user="user",
+                                                      password="password", api_key="key")
+
+from benchmark import import_times, heavy_imports
+
+
+class ImportTime(unittest.TestCase):
+    """Each module is imported with python -X importtime in a fresh interpreter."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.folder = tempfile.TemporaryDirectory()
+        cls.pythonpath = os.environ.get("PYTHONPATH")
+        if STANDIN is not None:
+            with open(os.path.join(cls.folder.name, "freshlogin.py"), "w") as standin:
+                standin.write(STANDIN)
+            os.environ["PYTHONPATH"] = os.pathsep.join(filter(None, [cls.folder.name, cls.pythonpath]))
+
+    @classmethod
+    def tearDownClass(cls):
+        if cls.pythonpath is None:
+            os.environ.pop("PYTHONPATH", None)
+        else:
+            os.environ["PYTHONPATH"] = cls.pythonpath
+        cls.folder.cleanup()
+
+    def test_main_loads_no_heavy_modules(self):
+        self.assertEqual(heavy_imports(import_times("main")), [])
+
+    def test_csv2cmdb_loads_no_heavy_modules(self):
+        self.assertEqual(heavy_imports(import_times("csv2cmdb")), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
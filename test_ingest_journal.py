@@ -0,0 +1,111 @@
+"""
+Resuming an ingest against the mock server in mock_freshservice.py.
+
+    python -m pytest test_ingest_journal.py
+"""
+
+import io
+import os
+import sys
+import types
+import tempfile
+import unittest
+from contextlib import redirect_stdout
+
+try:
+    import freshlogin
+except ImportError:
+    # the mock server needs no real credentials
+    sys.modules["freshlogin"] = types.SimpleNamespace(domain="localhost", user="user",
+                                                      password="password", api_key="key")
+
+import requests
+import csv2cmdb as c
+from benchmark import write_archi_export
+from mock_freshservice import MockFreshservice
+
+
+class ResumeAfterFailedCreates(unittest.TestCase):
+    """A first run whose creates partly fail rejects the relations touching those CIs; the
+    resumed run must create the CIs and then post exactly the missing relations."""
+
+    elements = 40
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        folder = self.folder.name
+        ci_types = [{"ci_type": {"id": int(type_id), "name": name}} for name, type_id in c.ASSET_DICT.items()]
+        relationship_types = [{"id": int(type_id), "forward_relationship": name,
+                               "created_at": "2019-01-01T00:00:00Z"} for name, type_id in c.RELA_DICT.items()]
+        self.mock = MockFreshservice(ci_types=ci_types, relationship_types=relationship_types).start()
+        self.elemfile, self.relfile = write_archi_export(folder, self.elements)
+        self.journal_file = os.path.join(folder, "journal.sqlite")
+        self.reject_file = os.path.join(folder, "rejected.csv")
+        self.saved = c.TYPE_MAP_CACHE, c.send
+        c.TYPE_MAP_CACHE = os.path.join(folder, "type_ids.json")
+        c.refresh_metadata()
+        c.configure_snapshot_cache(os.path.join(folder, "snapshots.sqlite"))
+        c.configure_client(base_url=self.mock.url)
+        c.configure_rate_limit(10 ** 9)
+
+    def tearDown(self):
+        c.TYPE_MAP_CACHE, c.send = self.saved
+        self.mock.stop()
+        self.folder.cleanup()
+
+    def journal(self, resume):
+        return c.IngestJournal(self.journal_file, resume, sources=[self.elemfile, self.relfile],
+                               elemfile=self.elemfile, relfile=self.relfile, chunksize=10)
+
+    def ingest(self, resume):
+        journal = self.journal(resume)
+        with redirect_stdout(io.StringIO()):
+            c.add_update_assets(self.elemfile, "csv", chunksize=10, journal=journal)
+            c.add_rela(self.relfile, self.elemfile, "csv", self.reject_file, chunksize=10, journal=journal)
+        left = journal.finish()
+        journal.close()
+        return left
+
+    def edges(self):
+        return [(source, relationship["config_item"]["display_id"], relationship["relationship_type_id"])
+                for source, relationships in self.mock.cmdb.relationships.items()
+                for relationship in relationships]
+
+    def test_resume_posts_relations_rejected_by_the_first_run(self):
+        send = c.send
+        failing = {f"id-{number:032x}" for number in range(0, self.elements, 4)}
+
+        def failing_creates(operation, *args, **kwargs):
+            if operation.method == "POST" and operation.label in failing:
+                response = requests.Response()
+                response.status_code, response._content = 400, b'{"errors": "refused"}'
+                return response
+            return send(operation, *args, **kwargs)
+
+        c.send = failing_creates
+        self.assertEqual(self.ingest(resume=False), len(failing))
+        self.assertEqual(len(self.mock.cmdb.items), self.elements - len(failing))
+        self.assertLess(len(self.edges()), self.elements)
+        self.assertTrue(os.path.exists(self.reject_file))
+
+        c.send = send
+        self.assertEqual(self.ingest(resume=True), 0)
+        self.assertEqual(len(self.mock.cmdb.items), self.elements)
+        self.assertFalse(os.path.exists(self.reject_file), "a clean run left the reject file behind")
+        edges = self.edges()
+        self.assertEqual(len(edges), self.elements)
+        self.assertEqual(len(set(edges)), len(edges), "a relationship was posted twice")
+        journal = self.journal(resume=True)
+        self.assertTrue(journal.finished)
+        journal.close()
+
+    def test_resume_refuses_an_overwritten_export(self):
+        self.journal(resume=False).close()
+        with open(self.elemfile, "a") as elements:
+            elements.write("id-extra,Node,Extra,\n")
+        with self.assertRaises(ValueError):
+            self.journal(resume=True)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,44 @@
+"""
+Serializing CI payloads with PayloadBuilder and sending them to the mock server in
+mock_freshservice.py.
+
+    python -m pytest test_payloads.py
+"""
+
+import sys
+import json
+import types
+import unittest
+
+try:
+    import freshlogin
+except ImportError:
+    # the mock server needs no real credentials
+    sys.modules["freshlogin"] = types.SimpleNamespace(domain="localhost", user="user",
+                                                      password="password", api_key="key")
+
+import csv2cmdb as c
+from mock_freshservice import MockFreshservice
+
+
+class NonAsciiPayloads(unittest.TestCase):
+
+    def setUp(self):
+        self.mock = MockFreshservice().start()
+        c.configure_client(base_url=self.mock.url)
+        c.configure_rate_limit(10 ** 9)
+
+    def tearDown(self):
+        self.mock.stop()
+
+    def test_body_is_sent_as_utf8(self):
+        change = c.Change("create", "id-1", None, "Data — Backbone", "10001075119", "Réseau", {})
+        payload = c.PayloadBuilder(lambda ci_type: {}).build(change)
+        response = c.send(c.Operation("POST", "/cmdb/items.json", payload, None, change.guid))
+        self.assertEqual(json.loads(response.request.body.decode("utf-8")), json.loads(payload))
+        item = self.mock.cmdb.items[response.json()["item"]["config_item"]["display_id"]]
+        self.assertEqual((item["name"], item["description"]), ("Data — Backbone", "Réseau"))
+
+
+if __name__ == "__main__":
+    unittest.main()
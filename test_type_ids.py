@@ -0,0 +1,86 @@
+"""
+Matching Freshservice type names onto Archi types, and caching the resolved mapping, against
+the mock server in mock_freshservice.py.
+
+    python -m pytest test_type_ids.py
+"""
+
+import io
+import os
+import sys
+import types
+import tempfile
+import unittest
+from contextlib import redirect_stdout
+
+try:
+    import freshlogin
+except ImportError:
+    # the mock server needs no real credentials
+    sys.modules["freshlogin"] = types.SimpleNamespace(domain="localhost", user="user",
+                                                      password="password", api_key="key")
+
+import requests
+import csv2cmdb as c
+from mock_freshservice import MockFreshservice
+
+
+class MatchTypes(unittest.TestCase):
+
+    def match(self, named_ids):
+        with redirect_stdout(io.StringIO()):
+            return c._match_types(named_ids, c.RELA_DICT, "Relationship")
+
+    def test_fuzzy_name_replaces_the_built_in_id(self):
+        resolved = self.match([("Assigned to", "9"), ("Composition", "8")])
+        self.assertEqual(resolved["AssignmentRelationship"], "9")
+        self.assertEqual(resolved["CompositionRelationship"], "8")
+
+    def test_exact_name_beats_a_fuzzy_one(self):
+        resolved = self.match([("Assigned to", "9"), ("Assignment", "7")])
+        self.assertEqual(resolved["AssignmentRelationship"], "7")
+
+
+class ResolveTypeIds(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        relationship_types = [{"id": 9, "forward_relationship": "Assigned to",
+                               "created_at": "2019-01-01T00:00:00Z"}]
+        ci_types = [{"ci_type": {"id": 5, "name": "Application Component"}}]
+        self.mock = MockFreshservice(ci_types=ci_types, relationship_types=relationship_types).start()
+        self.saved = c.TYPE_MAP_CACHE, c.send
+        c.TYPE_MAP_CACHE = os.path.join(self.folder.name, "type_ids.json")
+        c.refresh_metadata()
+        c.configure_client(base_url=self.mock.url)
+        c.configure_rate_limit(10 ** 9)
+
+    def tearDown(self):
+        c.TYPE_MAP_CACHE, c.send = self.saved
+        c.refresh_metadata()
+        self.mock.stop()
+        self.folder.cleanup()
+
+    def resolve(self):
+        with redirect_stdout(io.StringIO()):
+            return c.resolve_type_ids()
+
+    def test_failed_discovery_is_not_cached(self):
+        send = c.send
+
+        def unavailable(operation, *args, **kwargs):
+            response = requests.Response()
+            response.status_code, response._content = 503, b"{}"
+            return response
+
+        c.send = unavailable
+        assets, relationships = self.resolve()
+        self.assertEqual(relationships, c.RELA_DICT)
+        self.assertFalse(os.path.exists(c.TYPE_MAP_CACHE))
+
+        c.send = send
+        c.refresh_metadata()
+        assets, relationships = self.resolve()
+        self.assertEqual(assets["ApplicationComponent"], "5")
+        self.assertEqual(relationships["AssignmentRelationship"], "9")
+        self.assertTrue(os.path.exists(c.TYPE_MAP_CACHE))